@@ -4,70 +4,170 @@
 # Copyright Duke University 2020
 # License: MIT
 
+import heapq
 import numpy as np
-import pandas as pd
 from . import grouped_mr
 from . import generate_new_active_sets
 from . import flame_dame_helpers
+from . import flame_group_by
+from .matched_groups import MatchedGroups, MatchedPatterns
 
 
 
+class ActiveSets:
+    """The active covariate sets of a DAME run, lambda_h in the paper.
+
+    The sets are the masks of a CovariateLattice, kept in a min-heap keyed by
+    their PE, with ties going to the smallest mask, or by minus the weight
+    of the covariates they keep, with ties going to the largest mask. The
+    holdout and the weights do not change during a run, so each set is
+    scored once, when it becomes active, and the set to drop is popped off
+    the heap. A set that successive halving ruled out is kept with a lower
+    bound of its PE, the best PE of its batch, and only scored if it comes
+    to the top of the heap.
+
+    Attributes:
+        heap (list): the (key, tie, mask, exact) of every active set. exact
+            is False when key is only a lower bound of the PE of the set.
+        largest_first (bool): whether ties go to the largest mask.
+        num_failed (int): the number of active sets whose PE could not be
+            computed, eg the set of all covariates.
+    """
+    def __init__(self, largest_first=False):
+        self.heap = []
+        self.largest_first = largest_first
+        self.num_failed = 0
+
+    def push(self, mask, key, exact=True):
+        """Adds an active set"""
+        tie = -mask if self.largest_first else mask
+        heapq.heappush(self.heap, (key, tie, mask, exact))
+
+    def top(self):
+        """The (key, mask, exact) of the top set"""
+        key, _, mask, exact = self.heap[0]
+        return key, mask, exact
+
+    def pop(self):
+        """Removes and returns the (key, mask, exact) of the top set"""
+        key, _, mask, exact = heapq.heappop(self.heap)
+        return key, mask, exact
+
+    def masks(self):
+        """The masks of all active sets, in increasing order"""
+        return sorted(entry[2] for entry in self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+
+def score_active_sets(active_covar_sets, lattice, masks, adaptive_weights,
+                      treatment_column_name, outcome_column_name, df_holdout,
+                      alpha_given, pe_cache=None, pe_context=None,
+                      pe_engine=None, screen=None, n_jobs=1, weights=None):
+    """Scores new active sets, and adds them to the heap of active sets.
+
+    Args:
+        active_covar_sets (ActiveSets): the active sets.
+        lattice (CovariateLattice): the lattice of the masks of the sets.
+        masks: the masks of the new active sets.
+        n_jobs (int): the number of workers scoring the new sets at once.
+            The sets are scored in the order of their masks, so the PEs do
+            not depend on it.
+        weights: the weight array provided by the user, in the order of
+            lattice.covs. Without adaptive_weights, the key of a set is minus
+            the total weight of the covariates it does not hold, the ones
+            that are going to get used in the match.
+        The others are as in decide_drop.
+    """
+    if not adaptive_weights:
+        for mask in masks:
+            temp_weight = 0
+            for cov_index in range(len(lattice.covs)):
+                if not mask >> cov_index & 1:
+                    temp_weight += weights[cov_index]
+            active_covar_sets.push(mask, -temp_weight)
+        return
+
+    masks = sorted(masks)
+    pes = flame_dame_helpers.find_pe_for_covar_sets(
+        df_holdout, treatment_column_name, outcome_column_name,
+        [lattice.covar_set(mask) for mask in masks], adaptive_weights,
+        alpha_given, n_jobs, pe_cache, pe_context, pe_engine, screen)
+
+    # The sets ruled out by successive halving have the PE inf. They are
+    # clearly worse than the best set of the batch, so its PE is their bound.
+    bound = min([pe for pe in pes if type(pe) != bool], default=float("inf"))
+    for mask, PE in zip(masks, pes):
+        # error check. PE can be float(0), but not denote error
+        if not PE and type(PE) == bool:
+            active_covar_sets.num_failed += 1
+        elif PE == float("inf"):
+            active_covar_sets.push(mask, bound, False)
+        else:
+            active_covar_sets.push(mask, PE)
+
+
 def decide_drop(all_covs, active_covar_sets, weights, adaptive_weights,
                 treatment_column_name, outcome_column_name, df_holdout,
-                alpha_given):
+                alpha_given, pe_cache=None, pe_context=None, pe_engine=None,
+                lattice=None):
     """ This is a helper function to Algorithm 1 in the paper.
 
     Args:
         all_covs: This is an array of just the cov column names.
             Not including treat/outcome
-        active_covar_sets: A set of frozensets, representing all the active
-            covar sets
-        weights: This is the weight array provided by the user
+        active_covar_sets (ActiveSets): all the active covar sets, scored
+            with score_active_sets. The set to drop is removed from it.
+        weights: This is the weight array provided by the user. The weights
+            of the sets are in active_covar_sets already.
         adaptive_weights: This is the T/F provided by the user indicating
             whether to run ridge regression to decide who to drop.
         treatment_column_name (str): name of treatment column in df
         outcome_column_name (str): name of outcome column in df
-        df_holdout: The cleaned, user-provided dataframe with all rows/columns.
-            There are no changes made to this throughout the code. Used only in
-            testing/training for adaptive_weights version.
+        df_holdout (HoldoutArrays): The cleaned, user-provided holdout data,
+            split into the treated and control units. There are no changes
+            made to this throughout the code. Used only in testing/training
+            for adaptive_weights version.
+        pe_cache (PECache): optional, the PEs of covariate sets computed
+            before, and pe_context the key context of df_holdout in it.
+        pe_engine: optional, scores all of the sets at once, see
+            flame_dame_helpers.make_pe_engine.
+        lattice (CovariateLattice): the lattice of the masks of the sets.
     """
     curr_covar_set = set()
     best_pe = float("inf")
     if not adaptive_weights:
-        # We iterate through all active covariate sets and find the total
-        # weight of each . For each possible covariate set, temp_weight counts
-        # the total weight of the covs that are going to get used in the match,
-        # or the ones *not* in that possible cov set.
+        # The top of the heap is the active set that keeps the most weight in
+        # the covs that are going to get used in the match, or the ones *not*
+        # in that set. The last of the sets tied for it is dropped.
         max_weight = 0
-        for s in active_covar_sets: # s is a set to consider dropping
-            temp_weight = 0
-            for cov_index in range(len(all_covs)):  # iter through all covars
-                if all_covs[cov_index] not in s:
-                    # if an item not in s, add weight. finding impact of drop s
-                    temp_weight += weights[cov_index]
-            if temp_weight >= max_weight:
-                max_weight = temp_weight
-                curr_covar_set = s # This is the items we will drop, that will
-                # not get used in the match.
+        if len(active_covar_sets) and -active_covar_sets.top()[0] >= max_weight:
+            key, mask, _ = active_covar_sets.pop()
+            max_weight = -key
+            curr_covar_set = lattice.covar_set(mask) # This is the items we
+            # will drop, that will not get used in the match.
         best_pe = max_weight
 
     else:
-        # Iterate through all of the active_covar_sets and drop one at a time,
-        # and drop the one with the highest match quality score
-        for s in active_covar_sets:
-            # S is the frozenset of covars we drop. We try dropping each one
-            PE = flame_dame_helpers.find_pe_for_covar_set(df_holdout,
-                                                          treatment_column_name,
-                                                          outcome_column_name, s, adaptive_weights,
-                                                          alpha_given)
-            # error check. PE can be float(0), but not denote error
+        # Drop the active set with the smallest PE, the top of the heap.
+        if active_covar_sets.num_failed:
+            return False, False
+        while len(active_covar_sets):
+            PE, mask, exact = active_covar_sets.pop()
+            if exact:
+                best_pe = PE
+                curr_covar_set = lattice.covar_set(mask)
+                break
+            # The set was only bounded, so it is scored now, and its PE is
+            # no longer one that successive halving avoided.
+            PE = flame_dame_helpers.find_pe_for_covar_sets(
+                df_holdout, treatment_column_name, outcome_column_name,
+                [lattice.covar_set(mask)], adaptive_weights, alpha_given, 1,
+                pe_cache, pe_context, pe_engine, screened=True)[0]
             if not PE and type(PE) == bool:
                 return False, False
-
-            # Use the smallest PE as the covariate set to drop.
-            if PE < best_pe:
-                best_pe = PE
-                curr_covar_set = s
+            active_covar_sets.push(mask, PE)
 
     return curr_covar_set, best_pe
 
@@ -75,7 +175,9 @@ def decide_drop(all_covs, active_covar_sets, weights, adaptive_weights,
 def algo1(df_all, treatment_column_name="T", weight_array=[],
           outcome_column_name="outcome", adaptive_weights=False, alpha=0.1,
           df_holdout="", repeats=True, want_pe=False, verbose=0,
-          want_bf=False, missing_holdout_replace=False, early_stops=False):
+          want_bf=False, missing_holdout_replace=False, early_stops=False,
+          group_by_engine='hash', pe_cache=None, pe_context=None,
+          successive_halving=False, n_jobs=1):
     """This function does Algorithm 1 in the paper.
 
     Args:
@@ -107,13 +209,27 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
             imputations that MICE needs to do on the holdout dataset, which
             has NaNs in it that need to be replaced.
         early_stops (type EarlyStop): This is all of the possible stop criteria
+        group_by_engine (str): The backend used to form groups, one of
+            flame_group_by.GROUP_BY_ENGINES.
+        pe_cache (PECache): The PEs of covariate sets computed so far, eg in
+            previous runs on the same holdout. A new one if not given.
+        pe_context: The key context of df_holdout in pe_cache, see
+            flame_dame_helpers.pe_cache_context. Computed from df_holdout if
+            not given. FLAME passes it when handing off to DAME, since it has
+            already dropped covariates from df_holdout.
+        successive_halving (bool, int): If an int, the PEs of the covariate
+            sets are first estimated on samples of the holdout, starting with
+            that many units of each arm and doubling, and the sets that are
+            clearly worse than the best are ruled out, see SuccessiveHalving.
+        n_jobs (int): The number of workers scoring each batch of new active
+            sets.
 
     Returns:
-        return_df: df of units with the column values of their main matched
-            group, with "*"s in place for the columns not in their MMG;
-            includes a unit weights column which indicates the number of times
-            each unit was matched
-        MG_units: list of unit ids for every matched group
+        return_matches (MatchedPatterns): the column values of the main
+            matched group of every unit, and the number of times each unit
+            was matched. Its to_frame() is the df of matched units, with
+            "*"s in place for the columns not in their MMG
+        MG_units (MatchedGroups): unit ids for every matched group
     """
 
     # Initialize variables. These are all moving/temporary throughout algo
@@ -122,15 +238,25 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
     all_covs.remove(outcome_column_name)
     df_unmatched = df_all.copy(deep=True) # This is df_h in the paper
 
+    # The covariates factorized once for the whole run. compact_all always
+    # holds the same units as df_all, and unmatched flags the units of
+    # df_unmatched by their position in the original df_all.
+    compact_all = flame_dame_helpers.CompactCovariates(
+        df_all, all_covs, treatment_column_name)
+    unmatched = np.ones(len(df_all), dtype=bool)
+
+    # With the rollup engine, the groups are formed from the distinct
+    # covariate patterns of the units on all covariates.
+    patterns = None
+    if group_by_engine == 'rollup':
+        patterns = flame_group_by.PatternTable(compact_all,
+                                               range(len(all_covs)))
+
     # Initialize return values
     return_pe = []
     return_bf = []
-    MG_units = [] # list of unit ids for each matched group
-    # weights indicates the number of times each unit appears in a group
-    weights = pd.DataFrame(np.zeros(shape=(len(df_all.index), 1)),
-                           columns=['weights'],
-                           index=df_all.index)
-    return_matches = pd.DataFrame(columns=all_covs, index=df_all.index)
+    MG_units = MatchedGroups() # unit ids for each matched group
+    return_matches = MatchedPatterns(compact_all)
 
     # Initialize variables used in checking stopping criteria
     orig_len_df_all = len(df_all) # Need this bc of case where repeats=False
@@ -139,21 +265,15 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
     h = 0 # Iteration (0'th round of matching is exact matching)
 
     covs_match_on = all_covs
-    matched_rows, return_matches, units_in_g = grouped_mr.algo2_GroupedMR(
-        df_all, df_unmatched, covs_match_on, all_covs, treatment_column_name,
-        outcome_column_name, return_matches)
+    matched_units, return_matches, units_in_g, matched_counts = grouped_mr.algo2_GroupedMR(
+        compact_all, unmatched, covs_match_on, return_matches, group_by_engine,
+        patterns=patterns)
 
     if (len(units_in_g)) != 0:
-        bf = flame_dame_helpers.compute_bf(matched_rows, treatment_column_name, df_unmatched)
+        bf = flame_dame_helpers.compute_bf(matched_counts, treatment_column_name, df_unmatched)
 
         # add the newly matched groups to MG_units, which tracks units in groups
-        MG_units = MG_units + units_in_g
-        # update unit weights for all units which appear in the new groups
-        # flatten to 1 list, then add occurrences of unique units
-        flat_units_in_g = np.concatenate(units_in_g).ravel()
-        unique_units, occurrences = np.unique(flat_units_in_g, return_counts=True)
-        for index in range(len(unique_units)):
-            weights.loc[unique_units[index], 'weights'] += occurrences[index]
+        MG_units.extend(units_in_g, h)
     else:
         bf = 0
 
@@ -161,10 +281,22 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
     return_bf.append(bf)
 
     # Now remove the matched units
-    df_unmatched.drop(matched_rows.index, inplace=True)
+    df_unmatched.drop(compact_all.index[matched_units], inplace=True)
+    unmatched[matched_units] = False
 
     if not repeats:
         df_all = df_unmatched
+        compact_all = compact_all.take(unmatched[compact_all.units])
+        if patterns is not None:
+            patterns.remove(matched_units)
+
+    # The PEs of covariate sets are kept across iterations, and across runs
+    # on the same holdout data when the caller passes its pe_cache.
+    if pe_cache is None:
+        pe_cache = flame_dame_helpers.PECache()
+    if pe_context is None:
+        pe_context = flame_dame_helpers.pe_cache_context(
+            df_holdout, adaptive_weights, alpha, missing_holdout_replace)
 
     # set up all the extra dfs if needed
     if missing_holdout_replace:
@@ -178,10 +310,23 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
         x.append(df_holdout)
         df_holdout = x
 
+    # The holdout data is split into arrays of the treated and the control
+    # units once, so that each covariate set only selects its columns. The
+    # trees of decisiontreeCV are fit on indicator columns, built once too.
+    df_holdout = flame_dame_helpers.HoldoutArrays(
+        df_holdout, treatment_column_name, outcome_column_name,
+        adaptive_weights == 'decisiontreeCV')
+    pe_engine = flame_dame_helpers.make_pe_engine(df_holdout, adaptive_weights,
+                                                  alpha)
+    screen = None
+    if successive_halving:
+        screen = flame_dame_helpers.SuccessiveHalving(
+            df_holdout, adaptive_weights, alpha, successive_halving)
+
 		# Predictive error of starting covariate set
-    baseline_pe = flame_dame_helpers.find_pe_for_covar_set(
-				df_holdout, treatment_column_name, outcome_column_name, [],
-				adaptive_weights, alpha)
+    baseline_pe = flame_dame_helpers.find_pe_for_covar_sets(
+				df_holdout, treatment_column_name, outcome_column_name, [[]],
+				adaptive_weights, alpha, 1, pe_cache, pe_context, pe_engine)[0]
     return_pe.append(baseline_pe)
 
     # Here we initializing variables for the iterative portion of the code.
@@ -189,9 +334,16 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
     # paper, this is lambda_h. curr_covar_sets is the covariates chosen to be
     # dropped. In the paper, this is s*h. processed_covar_sets is the already
     # processed sets from previous iterations. In the paper, it's delta_h.
+    # The sets are kept as bitmasks over all_covs, and the processed sets
+    # are kept in the lattice.
 
-    active_covar_sets = set(frozenset([i]) for i in all_covs)
-    processed_covar_sets = set()
+    lattice = generate_new_active_sets.CovariateLattice(all_covs)
+    active_covar_sets = ActiveSets(largest_first=not adaptive_weights)
+    score_active_sets(active_covar_sets, lattice,
+                      [lattice.mask([i]) for i in all_covs], adaptive_weights,
+                      treatment_column_name, outcome_column_name, df_holdout,
+                      alpha, pe_cache, pe_context, pe_engine, screen, n_jobs,
+                      weight_array)
 
     if verbose == 3:
         flame_dame_helpers.verbose_output(h, len(MG_units),
@@ -221,7 +373,8 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
         # We find curr_covar_set, the best covariate set to drop.
         curr_covar_set, pe = decide_drop(
             all_covs, active_covar_sets, weight_array, adaptive_weights,
-            treatment_column_name, outcome_column_name, df_holdout, alpha)
+            treatment_column_name, outcome_column_name, df_holdout, alpha,
+            pe_cache, pe_context, pe_engine, lattice)
 
         # Check for error in above step:
         if not curr_covar_set:
@@ -234,19 +387,13 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
 
         covs_match_on = list(set(all_covs)-curr_covar_set)
 
-        matched_rows, return_matches, units_in_g = grouped_mr.algo2_GroupedMR(
-            df_all, df_unmatched, covs_match_on, all_covs, treatment_column_name,
-            outcome_column_name, return_matches)
+        matched_units, return_matches, units_in_g, matched_counts = grouped_mr.algo2_GroupedMR(
+            compact_all, unmatched, covs_match_on, return_matches,
+            group_by_engine, patterns=patterns)
 
         if (len(units_in_g)) != 0:
             # add the newly matched groups to MG_units, which tracks units in groups
-            MG_units = MG_units + units_in_g
-            # update unit weights for all units which appear in the new groups
-            # flatten to 1 list, then add occurrences of unique units
-            flat_units_in_g = np.concatenate(units_in_g).ravel()
-            unique_units, occurrences = np.unique(flat_units_in_g, return_counts=True)
-            for index in range(len(unique_units)):
-                weights.loc[unique_units[index], 'weights'] += occurrences[index]
+            MG_units.extend(units_in_g, h)
 
 
         # Check not equal to false because if it's turned off, value is False
@@ -258,12 +405,12 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
             break
         return_pe.append(pe)
 
-        # It's probably slow to compute this if people don't want it, so will
-        # want to add this, I think.
+        # The counts of the matched groups come with the match, so this only
+        # needs the number of available units.
         if want_bf:
             # compute balancing factor
-            mg_treated = matched_rows[treatment_column_name].sum()
-            mg_control = len(matched_rows) - mg_treated
+            mg_treated = matched_counts[0].sum()
+            mg_control = matched_counts[1].sum()
             available_treated = df_unmatched[treatment_column_name].sum()
             available_control = len(df_unmatched) - available_treated
             if (available_treated != 0 and available_control != 0):
@@ -272,25 +419,30 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
                 bf = np.nan
             return_bf.append(bf)
 
-        # Generate new active sets
-        Z_h = generate_new_active_sets.algo3GenerateNewActiveSets(curr_covar_set,
-                                                                  processed_covar_sets)
-
-        # Remove curr_covar_set from the set of active sets
-        active_covar_sets = active_covar_sets.difference([curr_covar_set])
+        # Generate new active sets. curr_covar_set was already removed from
+        # the active sets by decide_drop.
+        curr_mask = lattice.mask(curr_covar_set)
+        Z_h = lattice.new_active_sets(curr_mask)
 
-        # Update the set of active sets
-        active_covar_sets = active_covar_sets.union(Z_h)
+        # Update the set of active sets, scoring the new ones
+        score_active_sets(active_covar_sets, lattice, Z_h, adaptive_weights,
+                          treatment_column_name, outcome_column_name,
+                          df_holdout, alpha, pe_cache, pe_context, pe_engine,
+                          screen, n_jobs, weight_array)
 
-        # Update the set of already processed covariate-sets. This works bc
-        # processed_covar_sets is type set, but curr_covar_set is type frozenset
-        processed_covar_sets.add(curr_covar_set)
+        # Update the set of already processed covariate-sets
+        lattice.add_processed(curr_mask)
 
         # Remove matches.
-        df_unmatched = df_unmatched.drop(matched_rows.index, errors='ignore')
+        df_unmatched = df_unmatched.drop(compact_all.index[matched_units],
+                                         errors='ignore')
+        unmatched[matched_units] = False
 
         if not repeats:
             df_all = df_unmatched
+            compact_all = compact_all.take(unmatched[compact_all.units])
+            if patterns is not None:
+                patterns.remove(matched_units)
 
         # End of iter. Decide what to print to user depending on verbose var.
         if verbose == 1:
@@ -310,11 +462,7 @@ def algo1(df_all, treatment_column_name="T", weight_array=[],
             prev_iter_num_unmatched = len(df_unmatched)
 
     # end loop.
-    return_matches = return_matches.dropna(axis=0) # drop rows with nan, dont return unmatched stuff
-    return_package = [return_matches]
-
-    return_package[0] = return_package[0].join(weights)
-    return_package.append(MG_units)
+    return_package = [return_matches, MG_units]
 
     # the optional returns
     if want_pe:
@@ -11,6 +11,8 @@ import pandas as pd
 import numpy as np
 
 from . import early_stops
+from . import flame_dame_helpers
+from . import flame_group_by
 
 def read_files(input_data, holdout_data):
     """Both options can be either df or csv files and are parsed here.
@@ -82,7 +84,8 @@ def check_stops(stop_unmatched_c, early_stop_un_c_frac, stop_unmatched_t,
     return early_stops_obj
 
 def check_parameters(adaptive_weights, df_holdout, df_input, alpha, FLAME,
-                     weight_array=[], C=0.0, verbose=0):
+                     weight_array=[], C=0.0, verbose=0, group_by_engine='hash',
+                     n_jobs=1, successive_halving=False):
     '''
     This function processes the parameters that were passed to DAME/FLAME
     that aren't directly the input file or related to stop_criteria.
@@ -117,14 +120,17 @@ def check_parameters(adaptive_weights, df_holdout, df_input, alpha, FLAME,
 
         # make sure that adaptive_weights is a valid value.
         if (adaptive_weights not in ["ridge", "decisiontree", "ridgeCV", "decisiontreeCV"]):
-            # Check to see if adaptive_weights is an object of type scikit-model
-            if not (hasattr(adaptive_weights, 'fit') and hasattr(adaptive_weights, 'predict')):
+            # Check to see if adaptive_weights is an object of type
+            # scikit-model, or a PEEngine subclass
+            is_engine = isinstance(adaptive_weights, type) and \
+                issubclass(adaptive_weights, flame_dame_helpers.PEEngine)
+            if not is_engine and not (hasattr(adaptive_weights, 'fit') and hasattr(adaptive_weights, 'predict')):
                 raise Exception("Invalid input error. The acceptable values for "\
                             "the adaptive_weights parameter are 'ridge', "\
                             "'decisiontree', 'decisiontreeCV', or 'ridgeCV'. Additionally, "\
                             "adaptive-weights may be 'False' along "\
                             "with a weight array or may be a scikit learn object if it has"\
-                            " a fit, predict method.")
+                            " a fit, predict method, or a subclass of PEEngine.")
 
 
         # make sure the two dfs have the same number of columns first:
@@ -138,6 +144,19 @@ def check_parameters(adaptive_weights, df_holdout, df_input, alpha, FLAME,
             raise Exception('Invalid input error. The holdout and main '\
                             'dataset must have the same columns')
 
+    if group_by_engine not in flame_group_by.GROUP_BY_ENGINES:
+        raise Exception('Invalid input error. The group_by_engine must be '\
+                        'one of ' + str(flame_group_by.GROUP_BY_ENGINES))
+
+    if type(n_jobs) != int or n_jobs == 0:
+        raise Exception('Invalid input error. The n_jobs must be a nonzero '\
+                        'integer, or -1 to use all cores.')
+
+    if successive_halving is not False and \
+        (type(successive_halving) != int or successive_halving <= 0):
+        raise Exception('Invalid input error. The successive_halving must be '\
+                        'False, or a positive integer number of holdout units.')
+
     if FLAME:
         if C < 0.0:
             raise Exception('The C, or the hyperparameter to trade-off between'\
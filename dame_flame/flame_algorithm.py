@@ -6,15 +6,28 @@
 # License: MIT
 
 import numpy as np
-import pandas as pd
 
-from . import dame_algorithm, flame_dame_helpers, grouped_mr
+from . import dame_algorithm, flame_dame_helpers, flame_group_by, grouped_mr
+from .matched_groups import MatchedGroups, MatchedPatterns
 
 
-def decide_drop(all_covs, consider_dropping, prev_drop, df_all,
-                treatment_column_name, outcome_column_name, df_holdout_array,
-                adaptive_weights, alpha_given, df_unmatched, return_matches,
-                C, weight_array):
+def count_candidate_matches(compact_all, curr_keys, curr_covs, poss_drop,
+                            group_by_engine, patterns):
+    '''
+    The sizes of the matched groups on the current covariates curr_covs
+    without poss_drop, with the keys derived from those of curr_covs.
+    '''
+    covs_match_on = list(set(curr_covs).difference([poss_drop]))
+    keys = curr_keys.drop(compact_all.col_index[poss_drop])
+    return grouped_mr.count_matches(compact_all, covs_match_on,
+                                    group_by_engine, keys, patterns)
+
+def decide_drop(all_covs, consider_dropping, prev_drop, compact_all,
+                treatment_column_name, outcome_column_name, holdout,
+                adaptive_weights, alpha_given, df_unmatched, unmatched,
+                return_matches, C, weight_array, group_by_engine='hash',
+                patterns=None, n_jobs=1, pe_cache=None, pe_context=None,
+                pe_engine=None, screen=None):
     """
     This is a helper function, where we decide which covar to drop next
 
@@ -25,6 +38,26 @@ def decide_drop(all_covs, consider_dropping, prev_drop, df_all,
             been dropped in a previous iteration
         prev_drop (set): Covariate column names that have been dropped
             in a previous iteration
+        compact_all (CompactCovariates): the factorized covariates of the
+            units that can be matched
+        holdout (HoldoutArrays): the holdout data, split into the treated
+            and control units.
+        unmatched: boolean array over all units, True if not yet matched
+        return_matches (MatchedPatterns): the matches so far. Only the groups
+            of the chosen covariate set are added to it.
+        group_by_engine (str): the grouping backend, see
+            flame_group_by.GROUP_BY_ENGINES
+        patterns (PatternTable): the patterns of the units of compact_all on
+            the current covariate set, with the 'rollup' engine, else None.
+        n_jobs (int): the number of workers scoring the candidates at once.
+        pe_cache (PECache): optional, the PEs of covariate sets computed
+            before, and pe_context the key context of holdout in it,
+            see flame_dame_helpers.pe_cache_context.
+        pe_engine: optional, scores all candidates at once, see
+            flame_dame_helpers.make_pe_engine.
+        screen (SuccessiveHalving): optional, rules out the candidates whose
+            MQ is clearly lower than the best one's on samples of the
+            holdout, before their PEs are computed on all of it.
 
     """
 
@@ -32,11 +65,8 @@ def decide_drop(all_covs, consider_dropping, prev_drop, df_all,
     # value that gets outputted in the list described in readme.
     best_drop = 0
     best_mq = float("-inf")
-    best_return_matches = 0
-    best_matched_rows = 0
     best_bf = 0
     best_pe = 0
-    best_units_in_g = 0
 
     if not adaptive_weights:
         # find the covariate that can be dropped with the minimum value in
@@ -54,50 +84,62 @@ def decide_drop(all_covs, consider_dropping, prev_drop, df_all,
         covs_match_on = all_covs.difference([best_drop]).difference(prev_drop)
         covs_match_on = list(covs_match_on)
 
-        # need to make sure we don't edit the mutable dataframes, then do match
-        df_all_temp = df_all.copy(deep=True)
-        return_matches_temp = return_matches.copy(deep=True)
-        matched_rows, return_matches, units_in_g = grouped_mr.algo2_GroupedMR(
-            df_all_temp, df_unmatched, covs_match_on, all_covs,
-            treatment_column_name, outcome_column_name, return_matches_temp)
+        # only one set is considered, so match on it right away
+        matched_units, return_matches, units_in_g, matched_counts = grouped_mr.algo2_GroupedMR(
+            compact_all, unmatched, covs_match_on, return_matches,
+            group_by_engine, patterns=patterns)
 
         # find the BF for this covariate set's match.
-        BF = flame_dame_helpers.compute_bf(matched_rows,
+        BF = flame_dame_helpers.compute_bf(matched_counts,
                                            treatment_column_name, df_unmatched)
 
-        return best_drop, 0, matched_rows, return_matches, BF, units_in_g
+        return best_drop, 0, matched_units, return_matches, BF, units_in_g
 
     else:
-        for poss_drop in consider_dropping:
-            # S is the set of covars we drop. We try dropping each one
-            s = prev_drop.union([poss_drop])
-
-            PE = flame_dame_helpers.find_pe_for_covar_set(
-                df_holdout_array, treatment_column_name, outcome_column_name, s,
-                adaptive_weights, alpha_given)
-
-            # error check. PE can be float(0), but not denote error
+        # Every candidate set is the current covariate set minus one
+        # covariate, so encode the current set once and derive the keys of
+        # each candidate from it. The columns are sorted as in algo2_GroupedMR.
+        # With the rollup engine, the keys are those of the patterns.
+        curr_cols = sorted(compact_all.columns(set(all_covs).difference(prev_drop)))
+        curr_codes = compact_all.codes if patterns is None else patterns.codes
+        curr_keys = flame_group_by.MixedRadixKeys(
+            curr_codes, curr_cols, compact_all.cardinalities[curr_cols])
+
+        # Score the candidates concurrently: their groupings, which are numpy
+        # work, in threads, and their PEs in worker processes, unless they
+        # are cached. The results come back in the order of the candidates,
+        # so ties are broken as if they were scored one after the other.
+        candidates = list(consider_dropping)
+
+        # The BF only needs the sizes of the matched groups, so the groups
+        # themselves are only formed for the chosen set, below.
+        all_counts = flame_dame_helpers.run_parallel(
+            count_candidate_matches,
+            [(compact_all, curr_keys, set(all_covs).difference(prev_drop),
+              poss_drop, group_by_engine, patterns)
+             for poss_drop in candidates],
+            n_jobs, prefer='threads')
+        bfs = [flame_dame_helpers.compute_bf(
+            matched_counts, treatment_column_name, df_unmatched)
+               for matched_counts in all_counts]
+
+        # The BFs are known first, so that successive halving can compare
+        # the MQs of the candidates.
+        pes = flame_dame_helpers.find_pe_for_covar_sets(
+            holdout, treatment_column_name, outcome_column_name,
+            [prev_drop.union([poss_drop]) for poss_drop in candidates],
+            adaptive_weights, alpha_given, n_jobs, pe_cache, pe_context,
+            pe_engine, screen, [C * BF for BF in bfs])
+
+        # error check. PE can be float(0), but not denote error
+        for PE in pes:
             if not PE and type(PE) == bool:
                 return False, False, False, False, False
 
+        for poss_drop, PE, BF in zip(candidates, pes, bfs):
             # The dropping criteria for FLAME is max MQ
             # MQ = C * BF - PE
 
-            all_covs = set(all_covs)
-            covs_match_on = all_covs.difference([poss_drop]).difference(prev_drop)
-            covs_match_on = list(covs_match_on)
-
-            # need to make sure we don't edit the mutable dataframes, then do match
-            df_all_temp = df_all.copy(deep=True)
-            return_matches_temp = return_matches.copy(deep=True)
-            matched_rows, return_matches_temp, units_in_g = grouped_mr.algo2_GroupedMR(
-                df_all_temp, df_unmatched, covs_match_on, all_covs,
-                treatment_column_name, outcome_column_name, return_matches_temp)
-
-            # find the BF for this covariate set's match.
-            BF = flame_dame_helpers.compute_bf(
-                matched_rows, treatment_column_name, df_unmatched)
-
             # Use the largest MQ as the covariate set to drop.
             MQ = C * BF - PE
             if MQ > best_mq:
@@ -105,20 +147,29 @@ def decide_drop(all_covs, consider_dropping, prev_drop, df_all,
                 best_pe = PE
                 best_bf = BF
                 best_drop = poss_drop
-                best_return_matches = return_matches_temp
-                best_matched_rows = matched_rows
-                best_units_in_g = units_in_g
 
-        return best_drop, best_pe, best_matched_rows, best_return_matches, best_bf, best_units_in_g
+        if best_mq == float("-inf"):
+            return best_drop, best_pe, 0, return_matches, best_bf, 0
+
+        # match on the chosen set, adding its groups to return_matches
+        covs_match_on = list(set(all_covs).difference([best_drop]).difference(prev_drop))
+        matched_units, return_matches, units_in_g, matched_counts = grouped_mr.algo2_GroupedMR(
+            compact_all, unmatched, covs_match_on, return_matches,
+            group_by_engine, curr_keys.drop(compact_all.col_index[best_drop]),
+            patterns)
+
+        return best_drop, best_pe, matched_units, return_matches, best_bf, units_in_g
 
 def flame_generic(df_all, treatment_column_name, weight_array,
                   outcome_column_name, adaptive_weights, alpha, df_holdout,
                   repeats, want_pe, verbose, want_bf, missing_holdout_replace,
-                  early_stops, pre_dame, C):
+                  early_stops, pre_dame, C, group_by_engine='hash', n_jobs=1,
+                  pe_cache=None, successive_halving=False):
     '''
     All variables are the same as dame algorithm 1 except for:
     pre_dame(False, integer): Indicates whether the algorithm will move to
     DAME and after integer number of iterations.
+    n_jobs (int): the number of workers scoring the covariates to drop.
     '''
 
     # Initialize variables. These are all moving/temporary throughout algo
@@ -127,16 +178,26 @@ def flame_generic(df_all, treatment_column_name, weight_array,
     all_covs.remove(outcome_column_name)
     df_unmatched = df_all.copy(deep=True)
 
+    # The covariates factorized once for the whole run. compact_all always
+    # holds the same units as df_all, and unmatched flags the units of
+    # df_unmatched by their position in the original df_all.
+    compact_all = flame_dame_helpers.CompactCovariates(
+        df_all, all_covs, treatment_column_name)
+    unmatched = np.ones(len(df_all), dtype=bool)
+
+    # With the rollup engine, the groups are formed from the distinct
+    # covariate patterns of the units, coarsened as covariates are dropped.
+    patterns = None
+    if group_by_engine == 'rollup':
+        patterns = flame_group_by.PatternTable(compact_all,
+                                               range(len(all_covs)))
+
     # The items getting returned
     return_pe = [] # list of predictive errors,
     return_bf = []
-    MG_units = [] # list of unit ids for each matched group
-    # weights indicates the number of times each unit appears in a group
-    weights = pd.DataFrame(np.zeros(shape=(len(df_all.index), 1)),
-                           columns=['weights'],
-                           index=df_all.index)
+    MG_units = MatchedGroups() # unit ids for each matched group
 
-    return_matches = pd.DataFrame(columns=all_covs, index=df_all.index)
+    return_matches = MatchedPatterns(compact_all)
 
     # Initialize variables used in checking stopping criteria
     orig_len_df_all = len(df_all) # Need this bc of case where repeats=False
@@ -145,21 +206,15 @@ def flame_generic(df_all, treatment_column_name, weight_array,
     h = 0 # Iteration (0'th round of matching is exact matching)
 						
     covs_match_on = all_covs
-    matched_rows, return_matches, units_in_g = grouped_mr.algo2_GroupedMR(
-        df_all, df_unmatched, covs_match_on, all_covs, treatment_column_name,
-        outcome_column_name, return_matches)
+    matched_units, return_matches, units_in_g, matched_counts = grouped_mr.algo2_GroupedMR(
+        compact_all, unmatched, covs_match_on, return_matches, group_by_engine,
+        patterns=patterns)
 
     if (len(units_in_g)) != 0:
-        bf = flame_dame_helpers.compute_bf(matched_rows, treatment_column_name, df_unmatched)
+        bf = flame_dame_helpers.compute_bf(matched_counts, treatment_column_name, df_unmatched)
 
 				# add the newly matched groups to MG_units, which tracks units in groups
-        MG_units = MG_units + units_in_g
-        # update unit weights for all units which appear in the new groups
-        # flatten to 1 list, then add occurrences of unique units
-        flat_units_in_g = np.concatenate(units_in_g).ravel()
-        unique_units, occurrences = np.unique(flat_units_in_g, return_counts=True)
-        for index in range(len(unique_units)):
-            weights.loc[unique_units[index], 'weights'] += occurrences[index]
+        MG_units.extend(units_in_g, h)
     else:
         bf = 0
 
@@ -167,10 +222,21 @@ def flame_generic(df_all, treatment_column_name, weight_array,
     return_bf.append(bf)
 
     # Now remove the matched units
-    df_unmatched.drop(matched_rows.index, inplace=True)
+    df_unmatched.drop(compact_all.index[matched_units], inplace=True)
+    unmatched[matched_units] = False
 
     if not repeats:
         df_all = df_unmatched
+        compact_all = compact_all.take(unmatched[compact_all.units])
+        if patterns is not None:
+            patterns.remove(matched_units)
+
+    # The PEs of covariate sets are kept across iterations, and across runs
+    # on the same holdout data when the caller passes its pe_cache.
+    if pe_cache is None:
+        pe_cache = flame_dame_helpers.PECache()
+    pe_context = flame_dame_helpers.pe_cache_context(
+        df_holdout, adaptive_weights, alpha, missing_holdout_replace)
 
     # set up all the extra dfs if needed
     if missing_holdout_replace:
@@ -183,10 +249,23 @@ def flame_generic(df_all, treatment_column_name, weight_array,
         df_holdout_array = list()
         df_holdout_array.append(df_holdout)
 
+    # The holdout data is split into arrays of the treated and the control
+    # units once, so that each covariate set only selects its columns. The
+    # trees of decisiontreeCV are fit on indicator columns, built once too.
+    holdout = flame_dame_helpers.HoldoutArrays(
+        df_holdout_array, treatment_column_name, outcome_column_name,
+        adaptive_weights == 'decisiontreeCV')
+    pe_engine = flame_dame_helpers.make_pe_engine(holdout, adaptive_weights,
+                                                  alpha)
+    screen = None
+    if successive_halving:
+        screen = flame_dame_helpers.SuccessiveHalving(
+            holdout, adaptive_weights, alpha, successive_halving)
+
 		# Predictive error of starting covariate set
-    baseline_pe = flame_dame_helpers.find_pe_for_covar_set(
-				df_holdout_array, treatment_column_name, outcome_column_name, [],
-				adaptive_weights, alpha)
+    baseline_pe = flame_dame_helpers.find_pe_for_covar_sets(
+				holdout, treatment_column_name, outcome_column_name, [[]],
+				adaptive_weights, alpha, 1, pe_cache, pe_context, pe_engine)[0]
     return_pe.append(baseline_pe)
 
     if verbose == 3:
@@ -215,10 +294,12 @@ def flame_generic(df_all, treatment_column_name, weight_array,
 
         h += 1
 
-        new_drop, pe, matched_rows, return_matches, bf, units_in_g = decide_drop(all_covs,
-            consider_dropping, prev_dropped, df_all, treatment_column_name,
-            outcome_column_name, df_holdout_array, adaptive_weights, alpha,
-            df_unmatched, return_matches, C, weight_array)
+        new_drop, pe, matched_units, return_matches, bf, units_in_g = decide_drop(all_covs,
+            consider_dropping, prev_dropped, compact_all, treatment_column_name,
+            outcome_column_name, holdout, adaptive_weights, alpha,
+            df_unmatched, unmatched, return_matches, C, weight_array,
+            group_by_engine, patterns, n_jobs, pe_cache, pe_context,
+            pe_engine, screen)
 
         # Check for error in above step:
         if not new_drop:
@@ -229,13 +310,7 @@ def flame_generic(df_all, treatment_column_name, weight_array,
 
         if (len(units_in_g)) != 0:
         # add the newly matched groups to MG_units, which tracks units in groups
-            MG_units = MG_units + units_in_g
-            # update unit weights for all units which appear in the new groups
-            # flatten to 1 list, then add occurrences of unique units
-            flat_units_in_g = np.concatenate(units_in_g).ravel()
-            unique_units, occurrences = np.unique(flat_units_in_g, return_counts=True)
-            for index in range(len(unique_units)):
-                weights.loc[unique_units[index], 'weights'] += occurrences[index]
+            MG_units.extend(units_in_g, h)
 
         # Check not equal to false because if it's turned off, value is False
         baseline_pe = max(1e-12, baseline_pe)
@@ -251,12 +326,19 @@ def flame_generic(df_all, treatment_column_name, weight_array,
         # Update covariate groups for future iterations
         consider_dropping = consider_dropping.difference([new_drop])
         prev_dropped.add(new_drop)
+        if patterns is not None:
+            patterns.coarsen(compact_all.columns(consider_dropping))
 
         # Remove matches
-        df_unmatched = df_unmatched.drop(matched_rows.index, errors='ignore')
+        df_unmatched = df_unmatched.drop(compact_all.index[matched_units],
+                                         errors='ignore')
+        unmatched[matched_units] = False
 
         if not repeats:
             df_all = df_unmatched
+            compact_all = compact_all.take(unmatched[compact_all.units])
+            if patterns is not None:
+                patterns.remove(matched_units)
 
         # End of iter. Prints output based on verbose.
         if verbose == 1:
@@ -280,21 +362,21 @@ def flame_generic(df_all, treatment_column_name, weight_array,
                 df_holdout = df_holdout.loc[:, df_holdout.columns.drop(i)]
 
 
-            # call dame algorithm
+            # call dame algorithm. It shares the PEs computed so far, which
+            # are keyed by all of the covariates dropped from the holdout.
             print((orig_len_df_all - len(df_unmatched)), "units matched. "\
                   "Moving to DAME algorithm")
             return_matches_dame = dame_algorithm.algo1(
                 df_all, treatment_column_name, weight_array,
                 outcome_column_name, adaptive_weights, alpha, df_holdout,
                 repeats, want_pe, verbose, want_bf, missing_holdout_replace,
-                early_stops)
+                early_stops, group_by_engine, pe_cache,
+                pe_context[:2] + (frozenset(prev_dropped),),
+                successive_halving, n_jobs)
 
             # when dame is done, we
             # return the matches we made here, plus the matches made in dame.
 
-            # but first, make sure anything not matched isn't in the df:
-            return_matches = return_matches.dropna(axis=0) #drop rows with nan
-            return_matches = return_matches.join(weights)
             return_package = [return_matches, MG_units]
             if want_pe:
                 return_package.append(return_pe)
@@ -306,12 +388,7 @@ def flame_generic(df_all, treatment_column_name, weight_array,
 
         # end loop.
 
-    return_matches = return_matches.dropna(axis=0) #drop rows with nan
-    return_package = [return_matches]
-
-    # append weights and MGs to return package
-    return_package[0] = return_package[0].join(weights)
-    return_package.append(MG_units)
+    return_package = [return_matches, MG_units]
 
     if want_pe:
         return_package.append(return_pe)
@@ -5,9 +5,19 @@
 # Copyright Duke University 2020
 # License: MIT
 
+import copy
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
+from joblib import Parallel, delayed, effective_n_jobs
+
+from . import flame_group_by
+
+from scipy.stats import t as student_t
+from sklearn.base import clone
 from sklearn.linear_model import Ridge
 from sklearn.model_selection import cross_val_score
 
@@ -17,6 +27,58 @@ from sklearn.metrics import mean_squared_error
 from sklearn.experimental import enable_iterative_imputer
 from sklearn.impute import IterativeImputer
 
+class CompactCovariates:
+    '''
+    The covariates of the matching data, prepared once for a whole run of DAME
+    or FLAME. Every covariate is factorized into dense codes 0..k-1, and the
+    codes of all covariates are stored in one C-ordered matrix of the
+    smallest unsigned dtype that holds them, next to the treatment indicator.
+
+    Attributes:
+        covs (list): covariate column names, in the column order of codes.
+        col_index (dict): maps each covariate name to its column in codes.
+        codes: (number of rows, len(covs)) matrix of covariate codes.
+        treated: boolean array, whether each row is a treated unit.
+        cardinalities: array, the number of distinct values of each covariate.
+        uniques (list): for each covariate, the original value of each code.
+        index: the unit ids of all units of the run (index of df_all).
+        units: the position in index of each row. A run starts with all
+            units, and take() narrows this down to a subset of them.
+    '''
+    def __init__(self, df_all, covs, treatment_column_name):
+        self.covs = list(covs)
+        self.col_index = dict((cov, j) for j, cov in enumerate(self.covs))
+        self.index = df_all.index
+        self.units = np.arange(len(df_all))
+        self.treated = df_all[treatment_column_name].values == 1
+
+        factorized = [pd.factorize(df_all[cov], sort=True) for cov in self.covs]
+        self.uniques = [np.asarray(uniques) for _, uniques in factorized]
+        self.cardinalities = np.array([max(len(uniques), 1)
+                                       for uniques in self.uniques],
+                                      dtype=np.int64)
+        dtype = np.min_scalar_type(max(self.cardinalities.max(initial=1) - 1, 0))
+        self.codes = np.empty((len(df_all), len(self.covs)), dtype=dtype,
+                              order='C')
+        for j, (codes, _) in enumerate(factorized):
+            self.codes[:, j] = codes
+
+    def columns(self, covs):
+        ''' The columns of codes that hold the given covariates '''
+        return [self.col_index[cov] for cov in covs]
+
+    def take(self, rows):
+        '''
+        Returns the same covariates restricted to the given rows. The codes
+        of the original values, and so the cardinalities, are unchanged.
+        '''
+        subset = copy.copy(self)
+        subset.codes = self.codes[rows]
+        subset.treated = self.treated[rows]
+        subset.units = self.units[rows]
+        return subset
+
+
 def verbose_output(iteration_number, num_matched_groups, num_unmatched_t,
                    num_unmatched, orig_len_df_all, tot_treated, pe,
                    prev_iter_num_unmatched, curr_covar_set):
@@ -37,13 +99,15 @@ def verbose_output(iteration_number, num_matched_groups, num_unmatched_t,
     print("\tPredictive error of covariate set used to match: ", pe)
 
 
-def compute_bf(matched_rows, treatment_column_name, df_unmatched):
+def compute_bf(matched_counts, treatment_column_name, df_unmatched):
     '''
-    Helper function to compute the balancing factor
+    Helper function to compute the balancing factor. matched_counts is the
+    tuple of per-group treated and control counts of the matched groups,
+    as returned by algo2_GroupedMR.
     '''
 
-    mg_treated = matched_rows[treatment_column_name].sum()
-    mg_control = len(matched_rows) - mg_treated
+    mg_treated = matched_counts[0].sum()
+    mg_control = matched_counts[1].sum()
     available_treated = df_unmatched[treatment_column_name].sum()
     available_control = len(df_unmatched) - available_treated
 
@@ -54,43 +118,652 @@ def compute_bf(matched_rows, treatment_column_name, df_unmatched):
     return mg_treated/available_treated
 
 
+def run_parallel(function, arg_list, n_jobs=1, prefer='processes'):
+    '''
+    Calls function on each tuple of arguments in arg_list, on n_jobs workers
+    (-1 for all cores), and returns the results in the order of arg_list.
+    prefer is 'threads' for work that releases the GIL, like numpy, or
+    'processes' for work that doesn't, like most scikit-learn fits. With
+    processes, large arrays are passed to the workers by memory mapping.
+    '''
+    if n_jobs == 1 or len(arg_list) <= 1:
+        return [function(*args) for args in arg_list]
+    return Parallel(n_jobs=n_jobs, prefer=prefer)(
+        delayed(function)(*args) for args in arg_list)
+
+def call_on_batch(function, shared_args, arg_list):
+    '''Calls function(*shared_args, *args) on each tuple args of arg_list'''
+    return [function(*shared_args, *args) for args in arg_list]
+
+def run_parallel_batches(function, shared_args, arg_list, n_jobs=1,
+                         prefer='processes'):
+    '''
+    As run_parallel, calling function(*shared_args, *args) on each tuple of
+    arguments in arg_list. The calls are split into one batch of consecutive
+    calls per worker, so shared_args, eg the holdout arrays, are sent to each
+    worker once rather than with every call. The results are in the order
+    of arg_list, whatever n_jobs is.
+    '''
+    if n_jobs == 1 or len(arg_list) <= 1:
+        return call_on_batch(function, shared_args, arg_list)
+    num_batches = min(effective_n_jobs(n_jobs), len(arg_list))
+    bounds = np.linspace(0, len(arg_list), num_batches + 1).astype(int)
+    batches = run_parallel(
+        call_on_batch,
+        [(function, shared_args, arg_list[start:end])
+         for start, end in zip(bounds[:-1], bounds[1:])], n_jobs, prefer)
+    return [result for batch in batches for result in batch]
+
+class PECache:
+    '''
+    A bounded least recently used cache of the predictive errors of covariate
+    sets. The PE of a set only depends on the holdout data, on how the PE is
+    computed, and on the covariates dropped, so entries are keyed by
+    (holdout fingerprint, estimator config, frozenset of dropped covariates),
+    see pe_cache_context. One cache can be shared by FLAME, DAME and repeated
+    runs, since the key tells their holdouts and estimators apart.
+
+    Attributes:
+        maxsize (int): the most PEs kept. The least recently used one is
+            evicted first.
+        hits, misses (int): the number of lookups that found, or did not
+            find, their PE.
+        avoided (int): the number of PEs on the full holdout that were not
+            computed, because successive halving ruled their sets out. A set
+            ruled out and scored later on is not counted.
+    '''
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.avoided = 0
+
+    def get(self, key, count=True):
+        '''
+        The PE stored for key, or None. With count=False, the lookup is not
+        counted as a hit or a miss, eg when the key was looked up before.
+        '''
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += count
+            return self._entries[key]
+        self.misses += count
+        return None
+
+    def put(self, key, pe):
+        '''Stores the PE of key, evicting the least recently used PE'''
+        self._entries[key] = pe
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        '''Removes all PEs and resets the counters'''
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.avoided = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return 'PECache(hits={}, misses={}, avoided={}, size={}, maxsize={})'.format(
+            self.hits, self.misses, self.avoided, len(self), self.maxsize)
+
+
+def pe_cache_context(df_holdout, adaptive_weights, alpha_given,
+                     missing_holdout_replace, dropped=()):
+    '''
+    The parts of a PECache key that are the same for all covariate sets of a
+    run: a fingerprint of the holdout data, the estimator config, and the
+    covariates already dropped from df_holdout, eg by FLAME before it hands
+    off to DAME.
+    '''
+    digest = hashlib.sha1()
+    digest.update(repr((list(df_holdout.columns),
+                        [str(dtype) for dtype in df_holdout.dtypes])).encode())
+    digest.update(pd.util.hash_pandas_object(df_holdout, index=True).values.tobytes())
+
+    if isinstance(adaptive_weights, (str, bool, int, float)) or adaptive_weights is None:
+        estimator = adaptive_weights
+    elif isinstance(adaptive_weights, type):
+        # a PEEngine subclass
+        estimator = (adaptive_weights.__module__, adaptive_weights.__qualname__)
+    elif hasattr(adaptive_weights, 'get_params'):
+        # an unfitted scikit-learn style estimator is fully described by
+        # its class and parameters
+        estimator = (type(adaptive_weights).__module__,
+                     type(adaptive_weights).__name__,
+                     repr(sorted(adaptive_weights.get_params().items())))
+    else:
+        estimator = id(adaptive_weights)
+
+    return (digest.hexdigest(),
+            (estimator, alpha_given, missing_holdout_replace),
+            frozenset(dropped))
+
+class HoldoutArrays:
+    '''
+    The holdout data of a run, split once into numpy arrays of the
+    covariates and the outcomes of the treated and of the control units, so
+    that scoring a covariate set only selects its columns. With MICE on the
+    holdout data, there is one split for each imputed holdout.
+
+    Attributes:
+        covs (list): the covariate names, sorted, in the column order of the
+            covariate arrays.
+        holdouts (list): for each imputed holdout, the tuple (x_treated,
+            y_treated, x_control, y_control).
+        blocks (list): for each imputed holdout, the indicator columns of
+            every covariate of the treated and of the control units, see
+            one_hot(). None until they are needed, or built right away with
+            one_hot=True.
+    '''
+    def __init__(self, df_holdout_array, treatment_column_name,
+                 outcome_column_name, one_hot=False):
+        self.covs = list(df_holdout_array[0].columns.difference(
+            [outcome_column_name, treatment_column_name]))
+        self.holdouts = []
+        for df_holdout in df_holdout_array:
+            treated = df_holdout[treatment_column_name].values == 1
+            control = df_holdout[treatment_column_name].values == 0
+            x = df_holdout[self.covs].values
+            y = df_holdout[outcome_column_name].values
+            self.holdouts.append((x[treated], y[treated], x[control],
+                                  y[control]))
+        self.blocks = None
+        if one_hot:
+            self.one_hot()
+
+    def columns(self, covs_drop):
+        '''The columns of the covariates that are not in covs_drop'''
+        return [j for j, cov in enumerate(self.covs) if cov not in covs_drop]
+
+    @staticmethod
+    def _one_hot_arm(x):
+        '''
+        For each column of x, whether it is binary, and its block of
+        indicator columns: itself if it is binary, else one uint8 column
+        for each of its values, in the order of the values as strings.
+        '''
+        blocks = []
+        for j in range(x.shape[1]):
+            col = x[:, j]
+            if np.isin(pd.unique(col), [0, 1]).all():
+                blocks.append((True, col[:, None]))
+            else:
+                strs = col.astype(str)
+                values = np.unique(strs)
+                blocks.append((False, (strs[:, None] == values).astype(np.uint8)))
+        return blocks
+
+    def one_hot(self):
+        '''
+        The indicator columns of every covariate of each arm of each holdout,
+        computed the first time they are needed.
+        '''
+        if self.blocks is None:
+            self.blocks = [(self._one_hot_arm(x_treated),
+                            self._one_hot_arm(x_control))
+                           for x_treated, _, x_control, _ in self.holdouts]
+        return self.blocks
+
+    def binarized(self, holdout, arm, cols):
+        '''
+        The covariates in cols of the treated (arm 0) or control (arm 1) units
+        of a holdout, with the non-binary covariates replaced by their
+        indicator columns, as the decision trees are fit on. The blocks of the
+        non-binary covariates come first, as from pd.get_dummies on the
+        values as strings, followed by the binary covariates.
+        '''
+        blocks = self.one_hot()[holdout][arm]
+        order = [j for j in cols if not blocks[j][0]] + \
+            [j for j in cols if blocks[j][0]]
+        return np.hstack([blocks[j][1] for j in order])
+
+
+class PEEngine:
+    '''
+    The interface of the engines that compute the predictive errors of
+    covariate sets. An engine is made once per run from the HoldoutArrays of
+    the run and alpha, and is given all of the covariate sets scored in an
+    iteration at once, so that it can batch or warm start their fits. The
+    built-in engines are RidgeGramPE, GroupMeanPE and EstimatorPE, and a
+    subclass can be passed as adaptive_weights to use another one.
+    '''
+    def __init__(self, holdout, alpha_given=None):
+        self.holdout = holdout
+        self.alpha = alpha_given
+
+    def pe(self, covar_sets, n_jobs=1):
+        '''
+        The PE of each of covar_sets, the sets of covariates to drop, or False
+        where it can't be computed, as in find_pe_for_covar_set. n_jobs is
+        the number of workers the engine may use.
+        '''
+        raise NotImplementedError
+
+
+class RidgeGramPE(PEEngine):
+    '''
+    The ridge predictive errors of covariate sets, computed from the Gram
+    matrices of each treatment arm of the holdout data instead of fitting a
+    Ridge model for each set. For every fold of an arm, X^T X, X^T y, y^T y
+    and the sums of X and y are kept, after shifting the arm by its mean so
+    they are well conditioned. The stats of any set of rows are sums of
+    those, and those of a set of covariates are their rows and columns, so
+    a set is scored by solving its reduced, centered system, without going
+    over the holdout rows again. All sets with the same number of
+    covariates are solved in one batched call.
+
+    With cv=None, this gives the in-sample PEs of find_pe_for_covar_set with
+    adaptive_weights 'ridge'. With cv=5, the PEs of 'ridgeCV': each fold of
+    KFold(5), in order, is scored by the model fit on the other folds, whose
+    stats are those of the arm minus those of the fold. They agree with the
+    fits up to rounding, except that the sum of squared errors is expanded
+    from the stats, which loses precision when the fit is nearly perfect.
+    The sets whose sum of squared errors is within UNSTABLE_SSE of y^T y of
+    cancelling out, in any fold with cv, are scored by fitting them with
+    find_pe_for_covar_set.
+    '''
+    UNSTABLE_SSE = 1e-8
+
+    def __init__(self, holdout, alpha_given, cv=None):
+        self.holdout = holdout
+        self.alpha = alpha_given
+        self.cv = cv
+
+        # For each imputed holdout, the stats of the treated and of the
+        # control units: for each fold, n, the sums of X and y, X^T X, X^T y
+        # and y^T y, in arrays with one row per fold. num_rows is the
+        # number of units of the smallest arm.
+        self.arms = []
+        self.num_rows = min(len(y) for holdout_arrays in holdout.holdouts
+                            for y in holdout_arrays[1::2])
+        for x_treated, y_treated, x_control, y_control in holdout.holdouts:
+            for x, y in ((x_treated, y_treated), (x_control, y_control)):
+                if len(y) < (cv or 1):
+                    # the PEs can't be computed, or cross validated
+                    self.arms = None
+                    return
+                x = x.astype(float)
+                y = y.astype(float)
+                self.arms.append(self.fold_stats(x - x.mean(axis=0),
+                                                 y - y.mean()))
+
+    def fold_stats(self, x, y):
+        '''The stats of each fold of the rows of x and y, as KFold splits them'''
+        num_folds = self.cv or 1
+        sizes = np.full(num_folds, len(y) // num_folds)
+        sizes[:len(y) % num_folds] += 1
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        folds = [(x[a:b], y[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+        return (sizes.astype(float),
+                np.array([fx.sum(axis=0) for fx, _ in folds]),
+                np.array([fy.sum() for _, fy in folds]),
+                np.array([fx.T @ fx for fx, _ in folds]),
+                np.array([fx.T @ fy for fx, fy in folds]),
+                np.array([fy @ fy for _, fy in folds]))
+
+    def mse(self, train, test, cols):
+        '''
+        The MSE on the rows of the test stats of the ridge regression fit on
+        the rows of the train stats, on each row of cols, the columns of each
+        covariate set, all of the same length. Also whether the MSE of each
+        set lost too much precision to be used, see UNSTABLE_SSE.
+        '''
+        n, sx, sy, xtx, xty, _ = train
+        sx = sx[cols]
+        gram = xtx[cols[:, :, None], cols[:, None, :]] - \
+            np.einsum('ij,ik->ijk', sx, sx) / n
+        xy = xty[cols] - sx * sy / n
+        system = gram + self.alpha * np.eye(cols.shape[1])
+        try:
+            beta = np.linalg.solve(system, xy[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            # singular without regularization, as Ridge, use least squares
+            beta = np.array([np.linalg.lstsq(a, b, rcond=None)[0]
+                             for a, b in zip(system, xy)])
+        intercept = (sy - np.einsum('ij,ij->i', sx, beta)) / n
+
+        n, sx, sy, xtx, xty, yty = test
+        sse = yty - 2 * intercept * sy - \
+            2 * np.einsum('ij,ij->i', beta, xty[cols]) + \
+            n * intercept ** 2 + \
+            2 * intercept * np.einsum('ij,ij->i', beta, sx[cols]) + \
+            np.einsum('ij,ijk,ik->i', beta, xtx[cols[:, :, None], cols[:, None, :]], beta)
+        return np.maximum(sse, 0) / n, sse <= self.UNSTABLE_SSE * yty
+
+    def arm_mse(self, arm, cols):
+        '''
+        The in-sample, or mean cross validated, MSE of one arm, and whether
+        it lost too much precision in any fold
+        '''
+        total = [stat.sum(axis=0) for stat in arm]
+        if not self.cv:
+            return self.mse(total, total, cols)
+        fold_mse = [self.mse([t - stat[f] for t, stat in zip(total, arm)],
+                             [stat[f] for stat in arm], cols)
+                    for f in range(self.cv)]
+        return (np.mean([mse for mse, _ in fold_mse], axis=0),
+                np.any([unstable for _, unstable in fold_mse], axis=0))
+
+    def pe(self, covar_sets, n_jobs=1):
+        pes = [False] * len(covar_sets)
+        kept = [self.holdout.columns(s) for s in covar_sets]
+        if self.arms is None:
+            if self.num_rows and any(kept):
+                # as cross_val_score, on an arm with fewer units than folds
+                raise ValueError(
+                    'Cannot have number of splits n_splits={0} greater than '
+                    'the number of samples: n_samples={1}.'.format(
+                        self.cv, self.num_rows))
+            return pes
+
+        by_size = {}
+        for i, cols in enumerate(kept):
+            if cols:
+                by_size.setdefault(len(cols), []).append(i)
+
+        unstable = []
+        for positions in by_size.values():
+            cols = np.array([kept[i] for i in positions])
+            # the PE is the mean over the imputed holdouts of the sum of the
+            # MSE of the two arms
+            arm_mses = [self.arm_mse(arm, cols) for arm in self.arms]
+            total = sum(mse for mse, _ in arm_mses) / len(self.holdout.holdouts)
+            lost = np.any([lost for _, lost in arm_mses], axis=0)
+            for i, pe, lost_precision in zip(positions, total, lost):
+                pes[i] = float(pe)
+                if lost_precision:
+                    unstable.append(i)
+
+        # the sets the stats can't score precisely enough are fit instead
+        adaptive_weights = 'ridgeCV' if self.cv else 'ridge'
+        fit_pes = run_parallel_batches(
+            find_pe_for_covar_set, (self.holdout, None, None),
+            [(covar_sets[i], adaptive_weights, self.alpha) for i in unstable],
+            n_jobs)
+        for i, pe in zip(unstable, fit_pes):
+            pes[i] = pe
+        return pes
+
+
+class GroupMeanPE(PEEngine):
+    '''
+    The decision tree predictive errors of covariate sets, computed from the
+    cells of the covariates instead of fitting a tree for each set. The
+    covariates are discrete, so an unpruned DecisionTreeRegressor splits the
+    units until each leaf holds only units with the same values, or with the
+    same outcome, and predicts the mean outcome of the leaf. Its in-sample MSE
+    is then the within-cell variance of the outcome, where the cells are the
+    groups of units with the same values of the covariates kept. The
+    covariates of each arm are factorized once, and each set is scored by a
+    grouped mean over the codes of the covariates it keeps, without the
+    binarization the trees need.
+
+    This gives the PEs of find_pe_for_covar_set with adaptive_weights
+    'decisiontree'.
+    '''
+    def __init__(self, holdout, alpha_given=None):
+        self.holdout = holdout
+
+        # For each imputed holdout, the covariate codes, the number of
+        # distinct values of each covariate, and the outcomes of the treated
+        # and of the control units.
+        self.arms = []
+        for x_treated, y_treated, x_control, y_control in holdout.holdouts:
+            for x, y in ((x_treated, y_treated), (x_control, y_control)):
+                if not len(y):
+                    self.arms = None
+                    return
+                # missing values get a code of their own, after the others
+                factorized = [pd.factorize(x[:, j]) for j in range(x.shape[1])]
+                codes = np.column_stack(
+                    [np.where(codes < 0, len(uniques), codes)
+                     for codes, uniques in factorized])
+                radices = codes.max(axis=0) + 1
+                self.arms.append((codes, radices, y.astype(float)))
+
+    @staticmethod
+    def mse(arm, cols):
+        '''The within-cell MSE of the outcome of one arm, on cols'''
+        codes, radices, y = arm
+        keys = flame_group_by.encode_keys(codes, radices[cols], cols)
+        ids, num_groups = flame_group_by.group_ids(keys)
+        means = np.bincount(ids, y, num_groups) / np.bincount(ids, None, num_groups)
+        return np.mean((y - means[ids]) ** 2)
+
+    def pe(self, covar_sets, n_jobs=1):
+        pes = [False] * len(covar_sets)
+        if self.arms is None:
+            return pes
+
+        for i, s in enumerate(covar_sets):
+            cols = self.holdout.columns(s)
+            if cols:
+                pes[i] = float(sum(self.mse(arm, cols) for arm in self.arms) /
+                               len(self.holdout.holdouts))
+        return pes
+
+
+class EstimatorPE(PEEngine):
+    '''
+    The predictive errors of covariate sets from fitting an estimator on each
+    of them, with find_pe_for_covar_set, on n_jobs workers. Each fit is done
+    on a clone of the estimator, so the fits can run at the same time and the
+    estimator passed by the user is never fit. This is the engine of
+    'decisiontreeCV' and of scikit-learn estimators.
+    '''
+    def __init__(self, holdout, alpha_given, adaptive_weights):
+        self.holdout = holdout
+        self.alpha = alpha_given
+        self.adaptive_weights = adaptive_weights
+
+    def estimator(self):
+        '''A new copy of the estimator, or the name of the built-in one'''
+        if isinstance(self.adaptive_weights, str):
+            return self.adaptive_weights
+        try:
+            return clone(self.adaptive_weights)
+        except TypeError:
+            # not a scikit-learn estimator, without get_params
+            return copy.deepcopy(self.adaptive_weights)
+
+    def pe(self, covar_sets, n_jobs=1):
+        return run_parallel_batches(
+            find_pe_for_covar_set, (self.holdout, None, None),
+            [(s, self.estimator(), self.alpha) for s in covar_sets], n_jobs)
+
+
+def make_pe_engine(holdout, adaptive_weights, alpha_given):
+    '''
+    The PEEngine that computes the PEs of covariate sets for
+    adaptive_weights, from the HoldoutArrays of the run, or None if there
+    are no PEs, with adaptive_weights False.
+    '''
+    if isinstance(adaptive_weights, type) and issubclass(adaptive_weights, PEEngine):
+        return adaptive_weights(holdout, alpha_given)
+    if isinstance(adaptive_weights, str) and adaptive_weights == 'ridge':
+        return RidgeGramPE(holdout, alpha_given)
+    if isinstance(adaptive_weights, str) and adaptive_weights == 'decisiontree':
+        return GroupMeanPE(holdout)
+    if isinstance(adaptive_weights, str) and adaptive_weights == 'ridgeCV':
+        # cross_val_score with cv=5 uses KFold(5) for regressors
+        return RidgeGramPE(holdout, alpha_given, cv=5)
+    if isinstance(adaptive_weights, (bool, int, float)) or adaptive_weights is None:
+        return None
+    return EstimatorPE(holdout, alpha_given, adaptive_weights)
+
+class SuccessiveHalving:
+    '''
+    Rules out covariate sets on growing samples of the holdout data, before
+    their PEs are computed on all of it. The sets are scored on a sample of
+    min_rows units of each arm, split into num_chunks parts that are scored
+    separately, which gives the mean and standard error of the score of each
+    set. A set is ruled out when the lower bound of its score, mean - q * se,
+    is above the upper bound of the best set, mean + q * se. The sample is
+    then doubled, until one set is left or the sample would be over half of
+    the holdout. The score of a set is its PE minus its offset, eg C * BF in
+    FLAME, so the best set is the one with the smallest score.
+
+    The standard error comes from num_chunks - 1 degrees of freedom, so q is
+    the coverage quantile of Student's t distribution with that many degrees
+    of freedom, 3.18 for the defaults. Each bound then holds with
+    probability coverage, 0.975 by default, if the chunk scores are about
+    normal, and a set is ruled out wrongly with probability at most about
+    2 * (1 - coverage) at each sample size.
+    '''
+    def __init__(self, holdout, adaptive_weights, alpha_given, min_rows,
+                 num_chunks=4, coverage=0.975, random_state=0):
+        self.holdout = holdout
+        self.adaptive_weights = adaptive_weights
+        self.alpha = alpha_given
+        self.min_rows = min_rows
+        self.num_chunks = num_chunks
+        self.quantile = student_t.ppf(coverage, num_chunks - 1)
+
+        # The samples are the first rows of a fixed permutation of each arm,
+        # so each sample holds the previous one.
+        rng = np.random.RandomState(random_state)
+        self.orders = [(rng.permutation(len(y_treated)),
+                        rng.permutation(len(y_control)))
+                       for _, y_treated, _, y_control in holdout.holdouts]
+        self.num_rows = min(min(len(treated), len(control))
+                            for treated, control in self.orders)
+
+    def sample(self, rows, chunk):
+        '''
+        The HoldoutArrays of one chunk of the sample of the first rows units
+        of each arm
+        '''
+        sample = copy.copy(self.holdout)
+        sample.blocks = None
+        sample.holdouts = []
+        for (x_treated, y_treated, x_control, y_control), (treated, control) in \
+                zip(self.holdout.holdouts, self.orders):
+            treated = treated[:rows][chunk::self.num_chunks]
+            control = control[:rows][chunk::self.num_chunks]
+            sample.holdouts.append((x_treated[treated], y_treated[treated],
+                                    x_control[control], y_control[control]))
+        return sample
+
+    def screen(self, covar_sets, offsets, n_jobs=1):
+        '''
+        The positions in covar_sets of the sets that are not ruled out, given
+        the offset of the score of each set.
+        '''
+        offsets = np.asarray(offsets, dtype=float)
+        survivors = np.arange(len(covar_sets))
+        rows = self.min_rows
+        while len(survivors) > 1 and 2 * rows <= self.num_rows:
+            sets = [covar_sets[i] for i in survivors]
+            try:
+                chunk_pes = [make_pe_engine(self.sample(rows, chunk),
+                                            self.adaptive_weights,
+                                            self.alpha).pe(sets, n_jobs)
+                             for chunk in range(self.num_chunks)]
+            except ValueError:
+                # eg fewer units in a chunk than cross validation folds
+                break
+            if any(pe is False for pes in chunk_pes for pe in pes):
+                # the sample is too small to score the sets
+                break
+            scores = np.array(chunk_pes, dtype=float) - offsets[survivors]
+            mean = scores.mean(axis=0)
+            margin = self.quantile * scores.std(axis=0, ddof=1) / \
+                np.sqrt(self.num_chunks)
+            survivors = survivors[mean - margin <= (mean + margin).min()]
+            rows *= 2
+        return list(survivors)
+
+
+def find_pe_for_covar_sets(df_holdout, treatment_column_name,
+                           outcome_column_name, covar_sets, adaptive_weights,
+                           alpha_given, n_jobs=1, pe_cache=None,
+                           pe_context=None, pe_engine=None, screen=None,
+                           offsets=None, screened=False):
+    '''
+    The PEs of each of the covariate sets, as find_pe_for_covar_set, in the
+    order of covar_sets. df_holdout is the HoldoutArrays of the run, or the
+    list of holdout dataframes. With a pe_cache, and the pe_context of df_holdout,
+    the PEs it holds are not computed again and the new ones are added to it.
+    The others are computed all at once by pe_engine, a PEEngine that may use
+    n_jobs workers, or else one by one on n_jobs workers.
+
+    With a screen (SuccessiveHalving), the sets that it rules out, given the
+    offsets of their scores, get the PE inf instead, which is not cached.
+    With screened=True, the sets are ones it ruled out before, which are
+    scored after all: their lookups are not counted again, and the PEs
+    computed for them are no longer counted as avoided.
+    '''
+    pes = [None] * len(covar_sets)
+    keys = [None] * len(covar_sets)
+    if pe_cache is not None:
+        fingerprint, estimator, dropped = pe_context
+        for i, s in enumerate(covar_sets):
+            keys[i] = (fingerprint, estimator, dropped.union(s))
+            pes[i] = pe_cache.get(keys[i], not screened)
+
+    to_compute = [i for i, pe in enumerate(pes) if pe is None]
+    if screen is not None and len(to_compute) > 1:
+        if offsets is None:
+            offsets = np.zeros(len(covar_sets))
+        survivors = screen.screen([covar_sets[i] for i in to_compute],
+                                  np.asarray(offsets)[to_compute], n_jobs)
+        if pe_cache is not None:
+            pe_cache.avoided += len(to_compute) - len(survivors)
+        for i in to_compute:
+            pes[i] = float('inf')
+        to_compute = [to_compute[j] for j in survivors]
+
+    if pe_engine is not None:
+        new_pes = pe_engine.pe([covar_sets[i] for i in to_compute], n_jobs)
+    else:
+        new_pes = run_parallel_batches(
+            find_pe_for_covar_set,
+            (df_holdout, treatment_column_name, outcome_column_name),
+            [(covar_sets[i], adaptive_weights, alpha_given)
+             for i in to_compute], n_jobs)
+    for i, pe in zip(to_compute, new_pes):
+        pes[i] = pe
+        if pe_cache is not None:
+            pe_cache.put(keys[i], pe)
+    if screened and pe_cache is not None:
+        pe_cache.avoided -= len(to_compute)
+    return pes
+
 def find_pe_for_covar_set(df_holdout, treatment_column_name,
                           outcome_column_name, s, adaptive_weights,
                           alpha_given):
     '''
-    this is a helper function to decide_drop that will find pe of a given s
+    this is a helper function to decide_drop that will find pe of a given s.
+    df_holdout is the HoldoutArrays of the run, or the list of holdout
+    dataframes, which is split into them.
     '''
+    if not isinstance(df_holdout, HoldoutArrays):
+        df_holdout = HoldoutArrays(df_holdout, treatment_column_name,
+                                   outcome_column_name)
+    cols = df_holdout.columns(s)
+
     # The iteration and mean of array is only used when doing MICE on holdout
     pe_array = []
-    for i in range(len(df_holdout)):
-
-
-        x_treated, x_control, y_treated, y_control = separate_dfs(
-            df_holdout[i], treatment_column_name, outcome_column_name, s)
+    for i, (x_treated, y_treated, x_control, y_control) in enumerate(df_holdout.holdouts):
 
         # error check. If this is true, we stop matching.
-        if type(x_treated) == bool:
+        if len(y_treated) == 0 or len(y_control) == 0 or len(cols) == 0:
             return False
 
-        # binarize holdout dataset if categorical:
+        # binarize holdout dataset if categorical, from the cached indicator
+        # columns of each covariate:
         if (adaptive_weights == "decisiontree" or adaptive_weights == "decisiontreeCV"):
-
-            # first binarize non-binary columns in the treated dataset
-            bool_cols = bool_cols = [col for col in x_treated
-                                     if np.isin(x_treated[col].unique(), [0, 1]).all()]
-            non_bool_cols = x_treated.columns.difference(bool_cols)
-            if (len(non_bool_cols) != 0):    
-                binarized_df = pd.get_dummies(x_treated.loc[:, non_bool_cols].astype(str))
-                x_treated = pd.concat([binarized_df, x_treated.loc[:, bool_cols]], axis=1)
-
-            # binarize non-binary columns in the control dataset
-            bool_cols = bool_cols = [col for col in x_control
-                                     if np.isin(x_control[col].unique(), [0, 1]).all()]
-            non_bool_cols = x_control.columns.difference(bool_cols)
-            if (len(non_bool_cols) != 0):
-                binarized_df = pd.get_dummies(x_control.loc[:, non_bool_cols].astype(str))
-                x_control = pd.concat([binarized_df, x_control.loc[:, bool_cols]], axis=1)
-
+            x_treated = df_holdout.binarized(i, 0, cols)
+            x_control = df_holdout.binarized(i, 1, cols)
+        else:
+            x_treated = x_treated[:, cols]
+            x_control = x_control[:, cols]
 
         if adaptive_weights in ["ridge", "ridgeCV"]:
             clf = Ridge(alpha=alpha_given)
@@ -146,38 +819,6 @@ def create_mice_dfs(df_holdout, num_imputes, outcome_col_name):
 
     return df_holdout_array
 
-def separate_dfs(df_holdout, treatment_col_name, outcome_col_name,
-                 covs_drop):
-    """
-    This function serves to create the control/treatment dfs for use
-    in the decide_drop functions in flame and in dame.
-    """
-    #X-treated is the df that has rows where treated col = 1 and
-    # all cols except: outcome/treated/the covs being dropped
-    x_treated = df_holdout.loc[df_holdout[treatment_col_name] == 1,
-                               df_holdout.columns.difference([outcome_col_name,
-                                                              treatment_col_name] + list(covs_drop))]
-
-    #X-control is the df that has rows where treated col = 0 and
-    # all cols except: outcome/treated/the covs being dropped
-    x_control = df_holdout.loc[df_holdout[treatment_col_name] == 0,
-                               df_holdout.columns.difference([outcome_col_name,
-                                                              treatment_col_name] + list(covs_drop))]
-
-    y_treated = df_holdout.loc[df_holdout[treatment_col_name] == 1,
-                               outcome_col_name]
-
-    y_control = df_holdout.loc[df_holdout[treatment_col_name] == 0,
-                               outcome_col_name]
-
-    # error check. If this is true, we stop matching.
-    if (len(x_treated) == 0 or len(x_control) == 0 or \
-        len(y_treated) == 0 or len(y_control) == 0 or \
-        len(x_treated.columns) == 0 or len(x_control.columns) == 0):
-        return False, False, False, False
-
-    return x_treated, x_control, y_treated, y_control
-
 def stop_iterating(early_stops, df_unmatched, repeats, treat_col_name,
                    orig_len_df_all, h, orig_tot_treated, consider_dropping):
     """
@@ -6,39 +6,413 @@
 # License: MIT
 
 import numpy as np
+import pandas as pd
 
-def match_ng(df, covs, covs_max_list, treatment_indicator_col='treated'):
+# The grouping backends. 'sort' is the reference implementation, built on
+# np.unique. 'hash' assigns group ids in a single pass over the keys.
+# 'rollup' groups a table of the distinct covariate patterns, with the
+# 'hash' backend, instead of the units themselves.
+GROUP_BY_ENGINES = ('sort', 'hash', 'rollup')
+
+# Keys spanning at most this many values per unit are grouped by direct
+# addressing rather than hashing.
+DENSE_KEY_FACTOR = 4
+
+# Largest number of 64-bit words a structured key may span. Wider covariate
+# sets are hashed down to a single word, and checked for collisions.
+MAX_KEY_WORDS = 4
+
+_UINT64_RANGE = 2**64
+
+
+def radix_words(radices):
+    '''
+    Splits the columns into consecutive runs whose mixed-radix product fits in
+    a single uint64.
+
+    Input:
+        radices (list): the number of distinct values of each column.
+    Output:
+        list of (start, stop) column positions, one per 64-bit word.
+    '''
+    words = []
+    start = 0
+    product = 1
+    for i, radix in enumerate(radices):
+        radix = max(int(radix), 1)
+        if product * radix > _UINT64_RANGE and i > start:
+            words.append((start, i))
+            start = i
+            product = 1
+        product *= radix
+    words.append((start, len(radices)))
+    return words
+
+
+def _pack_word(arr, cols, radices):
+    '''
+    Mixed-radix encoding of the given columns of arr into one uint64 per row.
+    The caller guarantees that the product of the radices fits in 64 bits.
+    '''
+    key = np.zeros(arr.shape[0], dtype=np.uint64)
+    multiplier = 1
+    for col, radix in zip(cols, radices):
+        key += arr[:, col].astype(np.uint64) * np.uint64(multiplier)
+        multiplier *= max(int(radix), 1)
+    return key
+
+
+def _hash_words(words):
+    ''' Mixes each row of a (n, w) uint64 matrix into one uint64 '''
+    hashed = np.zeros(words.shape[0], dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for col in range(words.shape[1]):
+            # splitmix64 finalizer on the running hash xor the next word
+            hashed ^= words[:, col]
+            hashed += np.uint64(0x9E3779B97F4A7C15)
+            hashed ^= hashed >> np.uint64(30)
+            hashed *= np.uint64(0xBF58476D1CE4E5B9)
+            hashed ^= hashed >> np.uint64(27)
+            hashed *= np.uint64(0x94D049BB133111EB)
+            hashed ^= hashed >> np.uint64(31)
+    return hashed
+
+
+def _first_occurrence(ids, num_groups):
+    ''' Position of the first unit of every group '''
+    first = np.empty(num_groups, dtype=np.intp)
+    first[ids[::-1]] = np.arange(len(ids) - 1, -1, -1)
+    return first
+
+
+def _structured_key(words):
+    ''' Views each row of a (n, w) uint64 matrix as one opaque record '''
+    words = np.ascontiguousarray(words)
+    return words.view(np.dtype((np.void, 8 * words.shape[1]))).ravel()
+
+
+def _pack_words(arr, cols, radices, words):
+    ''' The (n, len(words)) matrix of mixed-radix words of every row '''
+    packed = np.empty((arr.shape[0], len(words)), dtype=np.uint64, order='F')
+    for i, (start, stop) in enumerate(words):
+        packed[:, i] = _pack_word(arr, cols[start:stop], radices[start:stop])
+    return packed
+
+
+def _finalize_keys(packed):
+    '''
+    Turns the packed words into keys: the word itself when there is only one,
+    a structured key up to MAX_KEY_WORDS words, and a collision-checked hash
+    of the words beyond that.
+    '''
+    if packed.shape[1] == 1:
+        return packed[:, 0]
+
+    if packed.shape[1] <= MAX_KEY_WORDS:
+        return _structured_key(packed)
+
+    hashed = _hash_words(packed)
+    ids, uniques = pd.factorize(hashed)
+    if (packed == packed[_first_occurrence(ids, len(uniques))[ids]]).all():
+        return hashed
+    return _structured_key(packed)
+
+
+def encode_keys(arr, radices, cols=None):
+    '''
+    Computes a group key for every row of arr, so that two rows share a key
+    if and only if they agree on every column. The narrowest exact encoding
+    is used: a single uint64 when the product of the radices fits, a
+    structured multi-word key when it does not, and a 64-bit hash of the
+    words for very wide covariate sets. A hash is only returned after
+    checking that it has no collisions on arr, otherwise the structured key
+    is used instead.
+
+    Input:
+        arr: (n, k) matrix of nonnegative integers.
+        radices (list): the number of distinct values of each column used,
+            the values in that column must be less than the radix.
+        cols (list): optional, the columns of arr to encode. All of them by
+            default. Selecting columns here avoids copying arr.
+    Output:
+        keys: array of length n, of dtype uint64 or void.
+    '''
+    if cols is None:
+        cols = range(arr.shape[1])
+    cols = list(cols)
+    radices = list(radices)
+    return _finalize_keys(_pack_words(arr, cols, radices, radix_words(radices)))
+
+
+class MixedRadixKeys:
+    '''
+    The packed mixed-radix words of every unit for one set of columns, kept
+    so that the keys of any set missing one of those columns can be derived
+    in O(n), by removing that column's contribution from its word, instead
+    of encoding all the remaining columns again. FLAME's candidate sets are
+    exactly these: the current covariates, minus one.
+
+    The derived keys equal encode_keys on the remaining columns whenever
+    those fit in a single word. Otherwise they are exact, but laid out in
+    the words of the full set.
+    '''
+    def __init__(self, arr, cols, radices):
+        self.cols = list(cols)
+        self.radices = [max(int(radix), 1) for radix in radices]
+        self.words = radix_words(self.radices)
+        self.packed = _pack_words(arr, self.cols, self.radices, self.words)
+
+    def keys(self):
+        ''' Keys of the full set of columns '''
+        return _finalize_keys(self.packed)
+
+    def drop(self, col):
+        ''' Keys of the set of columns without col, a column of arr '''
+        pos = self.cols.index(col)
+        radices = self.radices[:pos] + self.radices[pos + 1:]
+        i = [start <= pos < stop for start, stop in self.words].index(True)
+        start, stop = self.words[i]
+
+        # the word is low + value * multiplier + high * multiplier * radix,
+        # and without the column it is low + high * multiplier.
+        multiplier = int(np.prod(self.radices[start:pos], dtype=object))
+        span = multiplier * self.radices[pos]
+        word = self.packed[:, i]
+        new_word = word % np.uint64(multiplier)
+        if span < _UINT64_RANGE:
+            new_word += (word // np.uint64(span)) * np.uint64(multiplier)
+
+        if len(self.words) == 1:
+            return new_word
+
+        if len(radix_words(radices)) == 1:
+            # the remaining columns fit in one word, so concatenate the words
+            # into the same key that encode_keys would give.
+            key = np.zeros(len(word), dtype=np.uint64)
+            multiplier = 1
+            for j, (start, stop) in enumerate(self.words):
+                word_radices = self.radices[start:stop]
+                if j == i:
+                    key += new_word * np.uint64(multiplier)
+                    word_radices = word_radices[:pos - start] + word_radices[pos - start + 1:]
+                else:
+                    key += self.packed[:, j] * np.uint64(multiplier)
+                multiplier *= int(np.prod(word_radices, dtype=object))
+            return key
+
+        packed = self.packed.copy(order='F')
+        packed[:, i] = new_word
+        return _finalize_keys(packed)
+
+
+def _order_groups(keys, ids, num_groups):
+    '''
+    Renumbers the group ids so that they increase with the key of the group,
+    which makes the ids independent of the engine that assigned them.
+    '''
+    first = _first_occurrence(ids, num_groups)
+    rank = np.empty(num_groups, dtype=np.intp)
+    rank[np.argsort(keys[first], kind='stable')] = np.arange(num_groups)
+    return rank[ids]
+
+
+def _hash_group_ids(keys):
+    '''
+    Single pass group ids. Dense uint64 keys are looked up in an occupancy
+    table, other uint64 keys are hashed. Structured keys are hashed down to
+    one word, and only used if that hash has no collisions on keys.
+    Returns None if the structured key hash collides.
+    '''
+    if keys.dtype == np.uint64:
+        low = keys.min()
+        span = int(keys.max() - low) + 1
+        if span <= DENSE_KEY_FACTOR * len(keys):
+            offsets = (keys - low).astype(np.intp)
+            occupied = np.zeros(span, dtype=bool)
+            occupied[offsets] = True
+            lookup = np.cumsum(occupied) - 1
+            return lookup[offsets], int(lookup[-1]) + 1
+        ids, uniques = pd.factorize(keys, sort=True)
+        return ids, len(uniques)
+
+    words = keys.view(np.uint64).reshape(len(keys), -1)
+    ids, uniques = pd.factorize(_hash_words(words))
+    num_groups = len(uniques)
+    if not (words == words[_first_occurrence(ids, num_groups)[ids]]).all():
+        return None
+    return _order_groups(keys, ids, num_groups), num_groups
+
+
+def group_ids(keys, engine='hash'):
+    '''
+    Assigns every unit a dense group id from its key. Ids are numbered in
+    increasing key order, so every engine returns the same ids.
+
+    Input:
+        keys: array of group keys, as returned by encode_keys.
+        engine (str): one of GROUP_BY_ENGINES.
+    Output:
+        ids: array of the group id of each unit.
+        num_groups (int): the number of distinct keys.
+    '''
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.intp), 0
+    if engine == 'hash':
+        result = _hash_group_ids(keys)
+        if result is not None:
+            return result
+    uniques, ids = np.unique(keys, return_inverse=True)
+    return ids.ravel(), len(uniques)
+
+
+def group_counts(ids, num_groups, treated):
+    '''
+    Counts the treated and control units of every group in one pass.
+
+    Input:
+        ids: the group id of each unit, from group_ids.
+        num_groups (int): the number of groups.
+        treated: binary treatment indicator of each unit.
+    Output:
+        n_treated, n_control: arrays of length num_groups.
+    '''
+    n_total = np.bincount(ids, minlength=num_groups)
+    n_treated = np.bincount(ids[treated.astype(bool)], minlength=num_groups)
+    return n_treated, n_total - n_treated
+
+
+def match_ng(arr, covs, covs_max_list, treated, engine='hash', keys=None):
     '''
     This is the match_ng function
     '''
-    # this function takes a dataframe, a set of covariates to match on,
-    # the treatment indicator column and the matched indicator column.
+    # this function takes a matrix of covariate codes, the columns of it to
+    # match on with the number of distinct values of each, and the treatment
+    # indicator of each row. keys optionally gives the group key of each row
+    # for those columns, eg derived with MixedRadixKeys.
     # it returns the array indicating whether each unit is matched (the first return value),
-    # and a list of indices for the matched units (the second return value)
+    # the group id of each of the matched units (the second return value),
+    # and the number of treated and control units in every group (the last two)
 
     np.seterr(all='raise')
-    arr_slice_wo_t = df[covs].values # the covariates values as a matrix
 
-    # the covariate values together with the treatment indicator as a matrix
-    arr_slice_w_t = df[covs + [treatment_indicator_col]].values
+    # get a group key for each unit, wide enough to never overflow, unless
+    # the caller derived the keys already
+    if keys is None:
+        b_i = encode_keys(arr, covs_max_list, covs)
+    else:
+        b_i = keys
+
+    # one group id assignment for all units. unqtags_wo_t is the group id of
+    # each unit, ie the index to reconstruct the original array from the
+    # unique array
+    unqtags_wo_t, num_groups = group_ids(b_i, engine)
+
+    # count the treated and control units of every group together
+    n_treated, n_control = group_counts(unqtags_wo_t, num_groups, treated)
+
+    # a unit is matched if and only if its group has both treatments
+    match_indicator = ((n_treated > 0) & (n_control > 0))[unqtags_wo_t]
+    return match_indicator, unqtags_wo_t[match_indicator], n_treated, n_control
 
-    # matrix multiplication, get a unique number for each unit
-    b_i = np.dot(arr_slice_wo_t, np.power(covs_max_list, [i for i in range(len(covs_max_list))]))
 
-    # matrix multiplication, get a unique number for each unit with treatment indicator
-    b_i_plus = np.dot(arr_slice_w_t, np.append(np.power(covs_max_list, [i+1 for i in range(len(covs_max_list))]), [1]))
-    # b_i_plus = np.dot(arr_slice_w_t, np.array([covs_max_list[i]**(i+1) for i in range(len(covs_max_list))] + [1]))
+class PatternTable:
+    '''
+    The distinct covariate patterns of the units that can be matched, with
+    the number of treated and control units that have each pattern. Matching
+    on a subset of the covariates the patterns are distinct on only merges
+    patterns, so groups and their counts are found by aggregating this table,
+    in O(number of patterns) rather than O(number of units).
+
+    Attributes:
+        codes: (number of patterns, k) covariate codes of each pattern, in
+            the columns of CompactCovariates.codes. Only the columns in cols
+            are meaningful.
+        cols (list): the columns the patterns are distinct on.
+        radices: the number of distinct values of every column.
+        n_treated, n_control: arrays, the number of treated and control
+            units having each pattern.
+        unit_pattern: the pattern of every unit of the run, by position in
+            CompactCovariates.index. -1 for units not in the table.
+        unit_treated: boolean, whether every unit of the run is treated.
+    '''
+    def __init__(self, data, cols):
+        self.cols = sorted(cols)
+        self.radices = data.cardinalities
+        keys = encode_keys(data.codes, self.radices[self.cols], self.cols)
+        ids, num_patterns = group_ids(keys, 'hash')
+        self.codes = data.codes[_first_occurrence(ids, num_patterns)]
+        self.n_treated, self.n_control = group_counts(ids, num_patterns,
+                                                      data.treated)
+        self.unit_pattern = np.full(len(data.index), -1, dtype=np.intp)
+        self.unit_pattern[data.units] = ids
+        self.unit_treated = np.zeros(len(data.index), dtype=bool)
+        self.unit_treated[data.units] = data.treated
+
+    def group(self, cols, keys=None):
+        '''
+        Groups the patterns by the given columns, a subset of cols.
+
+        Input:
+            cols (list): the columns to group on.
+            keys: optional, the key of every pattern for those columns, eg
+                derived with MixedRadixKeys on codes.
+        Output:
+            pattern_group: the group id of every pattern.
+            num_groups (int): the number of groups.
+            n_treated, n_control: the number of treated and control units
+                of every group.
+        '''
+        if keys is None:
+            keys = encode_keys(self.codes, self.radices[cols], cols)
+        pattern_group, num_groups = group_ids(keys, 'hash')
+        n_treated = np.bincount(pattern_group, weights=self.n_treated,
+                                minlength=num_groups).astype(np.int64)
+        n_control = np.bincount(pattern_group, weights=self.n_control,
+                                minlength=num_groups).astype(np.int64)
+        return pattern_group, num_groups, n_treated, n_control
 
-    # count how many times each number appears
-    # unqtags_wo_t is index of the first occurrence of each unique val in b_i
-    # c_i is the index to reconstruct the original array from the unique array
-    _, unqtags_wo_t, c_i = np.unique(b_i, return_inverse=True,
-                                     return_counts=True)
+    def coarsen(self, cols):
+        '''
+        Merges the patterns that agree on the given columns, a subset of
+        cols, so that the table is only distinct on those from now on.
+        '''
+        cols = sorted(cols)
+        pattern_group, num_groups, n_treated, n_control = self.group(cols)
+        self.codes = self.codes[_first_occurrence(pattern_group, num_groups)]
+        self.n_treated, self.n_control = n_treated, n_control
+        in_table = self.unit_pattern >= 0
+        self.unit_pattern[in_table] = pattern_group[self.unit_pattern[in_table]]
+        self.cols = cols
 
-    # count how many times each number appears (with treatment indicator)
-    _, unqtags_w_t, c_i_plus = np.unique(b_i_plus, return_inverse=True,
-                                         return_counts=True)
+    def remove(self, units):
+        '''
+        Takes the given units, by position, out of the counts, for example
+        once they are matched when matching without repeats.
+        '''
+        units = units[self.unit_pattern[units] >= 0]
+        patterns = self.unit_pattern[units]
+        n_removed = np.bincount(patterns, minlength=len(self.n_treated))
+        n_removed_t = np.bincount(patterns[self.unit_treated[units]],
+                                  minlength=len(self.n_treated))
+        self.n_treated = self.n_treated - n_removed_t
+        self.n_control = self.n_control - (n_removed - n_removed_t)
+        self.unit_pattern[units] = -1
 
-    # a unit is matched if and only if the counts don't agree
-    match_indicator = ~(c_i_plus[unqtags_w_t] == c_i[unqtags_wo_t])
-    return match_indicator, b_i[match_indicator]
+
+def match_patterns(patterns, units, cols, keys=None):
+    '''
+    The same as match_ng, but groups the pattern table and looks up the group
+    of every unit from its pattern.
+
+    Input:
+        patterns (PatternTable): the patterns of the units.
+        units: positions of the units to match, all of them in the table.
+        cols (list): the columns to match on.
+        keys: optional, the key of every pattern for those columns.
+    Output:
+        the same as match_ng, for the given units.
+    '''
+    pattern_group, _, n_treated, n_control = patterns.group(cols, keys)
+    unit_group = pattern_group[patterns.unit_pattern[units]]
+    match_indicator = ((n_treated > 0) & (n_control > 0))[unit_group]
+    return match_indicator, unit_group[match_indicator], n_treated, n_control
@@ -5,7 +5,115 @@
 # Copyright Duke University 2020
 # License: MIT
 
-import itertools
+
+class CovariateLattice:
+    """The covariate sets of a DAME run, stored as integer bitmasks.
+
+    Bit j of a mask is set when the set holds covs[j], so set operations are
+    bitwise operations and the size of a set is the popcount of its mask.
+    The processed sets (delta in the paper) are bucketed by their size, and
+    the support of every covariate among the processed sets of each size is
+    counted as the sets are added, so Algorithm 3 does not go through the
+    sets processed before.
+
+    Attributes:
+        covs (list): the covariate names, in bit order.
+        processed (dict): maps each size k to the set of the masks of the
+            processed sets of size k.
+        support (dict): maps each size k to the list of the number of
+            processed sets of size k that each covariate is in.
+        supported (dict): maps each size k to the mask of the covariates
+            that are in at least k processed sets of size k.
+    """
+    def __init__(self, covs):
+        self.covs = list(covs)
+        self.bit = dict((cov, 1 << j) for j, cov in enumerate(self.covs))
+        self.processed = dict()
+        self.support = dict()
+        self.supported = dict()
+
+    def mask(self, covar_set):
+        """The mask of a set of covariate names"""
+        mask = 0
+        for cov in covar_set:
+            mask |= self.bit[cov]
+        return mask
+
+    def covar_set(self, mask):
+        """The frozenset of the covariate names of a mask"""
+        return frozenset(cov for j, cov in enumerate(self.covs)
+                         if mask >> j & 1)
+
+    @staticmethod
+    def bits(mask):
+        """The positions of the bits set in a mask, lowest first"""
+        while mask:
+            low_bit = mask & -mask
+            yield low_bit.bit_length() - 1
+            mask ^= low_bit
+
+    def add_processed(self, mask):
+        """Adds a set to the processed sets, and counts its covariates"""
+        size = bin(mask).count('1')
+        processed = self.processed.setdefault(size, set())
+        if mask in processed:
+            return
+        processed.add(mask)
+        support = self.support.setdefault(size, [0] * len(self.covs))
+        for j in self.bits(mask):
+            support[j] += 1
+            if support[j] == size:
+                self.supported[size] = self.supported.get(size, 0) | 1 << j
+
+    def new_active_sets(self, newly_dropped):
+        """This function does Algorithm 3 in the paper, on masks.
+
+        Args:
+            newly_dropped: the mask of a newly dropped set of size k, which
+                is not processed yet. This is s in the paper.
+
+        Returns:
+            Z, the new active sets. Stored as a set of masks.
+        """
+        new_active_sets = set() # this is Z in the paper
+        size_newly_dropped = bin(newly_dropped).count('1') # this is k
+
+        # Step 3: delta_k is all processed sets of size k, and s.
+        processed_k = self.processed.get(size_newly_dropped, set())
+
+        # Steps 4 and 5: s_e is the support of covariate e in delta_k. It is
+        # counted for the processed sets, and s adds one to its covariates.
+        support = self.support.get(size_newly_dropped)
+        if support is None:
+            support = [0] * len(self.covs)
+
+        # Step 7: do all covariates in s have enough support in delta_k?
+        for j in self.bits(newly_dropped):
+            if support[j] + 1 < size_newly_dropped:
+                return new_active_sets
+
+        # Step 6: omega is all the covariates not in s with enough support
+        omega = self.supported.get(size_newly_dropped, 0) & ~newly_dropped
+
+        # Step 8
+        for alpha in self.bits(omega):
+            # Step 9
+            r = newly_dropped | (1 << alpha)
+
+            # Step 10: the subsets of r of size k are r without one of its
+            # covariates. Are they all in delta_k? r without alpha is s.
+            allin = True
+            for j in self.bits(newly_dropped):
+                if r ^ (1 << j) not in processed_k:
+                    allin = False
+                    break
+
+            if allin:
+                # Step 11: Add r to Z
+                new_active_sets.add(r)
+
+        return new_active_sets
+
 
 def algo3GenerateNewActiveSets(newly_dropped, prev_processed):
     """This function does Algorithm 3 in the paper.
@@ -20,68 +128,11 @@ def algo3GenerateNewActiveSets(newly_dropped, prev_processed):
         Z, the new active sets. Stored as set of frozensets.
 
     """
-    new_active_sets = set() # this is Z in the paper
-    size_newly_dropped = len(list(newly_dropped)) # this is k in the paper
-    set_newly_dropped = set(newly_dropped)
-
-    # Step 3: delta_k is a set of frozensets.
-    # it contains all subsets of delta that are size k, and s.
-    subsets_size_k = set()
-    for fs_prevprocessed in prev_processed:
-        if len(fs_prevprocessed) == size_newly_dropped:
-            subsets_size_k.add(fs_prevprocessed)
-    subsets_size_k.add(newly_dropped)
-    delta_k = subsets_size_k
-
-    # Step 4: rho is all the covariates contained in sets in delta_k
-    rho = set()
-    for tup in delta_k:
-        for i in tup:
-            rho.add(i)
-
-    # Step 5: s_e is the support of covariate e in delta_k, for covars in rho
-    # possible time efficiency exploration: combine this with above loop, 
-    # calculating rho in one step
-    s_e = dict()
-    for covar_e in rho:
-        s_e[covar_e] = 0
-        for tup in delta_k:
-            if covar_e in tup:
-                s_e[covar_e] += 1
-
-    # Step 6: omega is all the covariates not in s that have enough support
-    # .items() iterates through key,val pairs
-    # so dict_covars_eno is the dictionary of all covariates that have enough support
-    dict_covars_eno = dict((key, val) for key, val in s_e.items() if val >= size_newly_dropped)
-    omega = set(dict_covars_eno.keys())
-    omega = omega.difference(set_newly_dropped)
-
-
-    # Step 7: do all covariates in S have enough support in delta_k?
-    for covar_e, support_e in s_e.items():
-        if covar_e in newly_dropped and support_e < size_newly_dropped:
-            return new_active_sets
-
-    # Step 8
-    for alpha in omega:
-        # Step 9
-        r = set_newly_dropped.union(set([alpha]))
-
-        # Step 10: Get all subsets of size_newly_dropped in r, check if belong in delta_k
-
-        # Have to convert these to sets and frozen sets before doing the search
-        delta_k = set(frozenset(i) for i in delta_k)
-        subsets_size_k = set(list(itertools.combinations(r, size_newly_dropped)))
-        subsets_size_k = set(frozenset(i) for i in subsets_size_k)
-
-        allin = True
-        for subset in subsets_size_k:
-            if subset not in delta_k:
-                allin = False
-                break
-
-        if allin:
-            # Step 11: Add r to Z
-            new_active_sets.add(frozenset(r))
-
-    return new_active_sets
+    covs = set(newly_dropped)
+    for covar_set in prev_processed:
+        covs.update(covar_set)
+    lattice = CovariateLattice(sorted(covs, key=str))
+    for covar_set in prev_processed:
+        lattice.add_processed(lattice.mask(covar_set))
+    return set(lattice.covar_set(mask) for mask in
+               lattice.new_active_sets(lattice.mask(newly_dropped)))
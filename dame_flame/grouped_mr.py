@@ -6,87 +6,126 @@
 # Copyright Duke University 2020
 # License: MIT
 
-from operator import itemgetter
 import numpy as np
 from . import flame_group_by
+from .matched_groups import MatchedGroups
 
-def algo2_GroupedMR(df_all, df_unmatched, covs_match_on, all_covs, treatment_column_name,
-                    outcome_column_name, return_groups):
+def algo2_GroupedMR(data, unmatched, covs_match_on, return_groups,
+                    group_by_engine='hash', keys=None, patterns=None):
     '''
     Input:
-        df_all: The dataframe of all of the data
-        df_unmatched: The dataframe ofjust hte unmatched data, a subset of df
+        data (CompactCovariates): The factorized covariates of the units that
+            can be matched. All of the data, or only the unmatched units
+            when matching without repeats.
+        unmatched: boolean array over all units of the run, True for the
+            units that have not been matched yet.
         covs_match_on (array): List of strs with name of columns of df.
             A subset of indexes of all covariates.
-        all_covs (array): list of all covariates.
+        return_groups (MatchedPatterns): the covariates that every unit
+            matched so far was matched on, and the number of groups each
+            unit is in.
+        group_by_engine (str): the grouping backend used by match_ng, one of
+            flame_group_by.GROUP_BY_ENGINES.
+        keys: optional, the group key of each row of data for covs_match_on,
+            eg derived with flame_group_by.MixedRadixKeys. Computed from the
+            codes if not given. With patterns, the key of each pattern.
+        patterns (PatternTable): optional, the patterns of the units of data.
+            If given, the groups are formed on the patterns rather than on
+            the units, as the 'rollup' engine does.
     Output:
-        matched_rows: newly matched units using covs indexed by Js. Type df
-        return_groups: The df of unit id and covar values matched on, with '*"
-            for the irrelevant ones.
-        all_units_in_g: list of unit ids for all matched groups created
+        matched_units: positions (in data.index) of all units in a matched
+            group using covs_match_on.
+        return_groups (MatchedPatterns): with the newly matched units added.
+        all_units_in_g (MatchedGroups): unit ids of the matched groups
+            created that have a newly matched unit, in increasing order of
+            their group key on cols. The columns are in the order of the
+            covariates in data, not sorted by their number of distinct
+            values as in earlier versions, so the groups can come in a
+            different order than they did.
+        matched_counts: tuple of arrays, the number of treated and of control
+            units in each matched group (all of them, not only the groups
+            with newly matched units)
 
     '''
-    # Find max of columns and make sure list of columns and list of maximums
-    # is sorted from least to greatest
-
-    # This is a list of tuples (max_of_column, column_name)
-    covs_max_tuples = [(max(df_all[x])+1, x) for x in covs_match_on]
-    covs_max_tuples = sorted(covs_max_tuples, key=itemgetter(0))
-
-    # Now covs_match_on is a list of covars and covs_max_list is their maximums
-    covs_max_list, covs_match_on = map(list, zip(*covs_max_tuples))
-
+    # The columns of the covariate codes to match on, and the number of
+    # distinct values in each of them. Sorted so that the order of the groups
+    # does not depend on the order of covs_match_on.
+    cols = sorted(data.columns(covs_match_on))
 
     # Form groups on D by exact matching on Js.
-
-    df_all_without_outcome = df_all.drop([outcome_column_name], axis=1)
-
-    matched_units, bi = flame_group_by.match_ng(df_all_without_outcome,
-                                                covs_match_on, covs_max_list,
-                                                treatment_column_name)
+    if patterns is not None:
+        matched, bi, n_treated, n_control = flame_group_by.match_patterns(
+            patterns, data.units, cols, keys)
+    else:
+        matched, bi, n_treated, n_control = flame_group_by.match_ng(
+            data.codes, cols, data.cardinalities[cols], data.treated,
+            group_by_engine, keys)
     # Find newly matched units and their main matched groups.
 
-    # These are the rows of the ones that have been matched:
-    matched_rows = df_all.loc[matched_units, :].copy()
-    matched_rows['b_i'] = bi
-
-    # These are the unique values in the bi col. length = number of groups
-    unique_matched_row_vals = np.unique(bi)
-
-    # Each element in this list represents a matched group and contains all of
-    # the unit ids belonging to that particular group
-    all_units_in_g = []
-    for bi_val in unique_matched_row_vals:
-        # type "int64index", ~ list, all of the unit_numbers in a matched group.
-        units_in_g = matched_rows.index[matched_rows['b_i'] == bi_val]
-
-        # Which of the units of this new group haven't been matched yet?
-        # unique_matched is a subset of units in the matched group, just the
-        # ones for whom this is their main matched group.
-        newly_matched = [i for i in units_in_g if i in df_unmatched.index]
-        # Only need to proceed to fill in the return table if someone's MMG found.
-        if len(newly_matched) != 0:
-
-            all_units_in_g.append(list(units_in_g))
-
-            # Now, we figure out: What does the group look like? eg [1,2,*,1]
-            temp_row_in_group = matched_rows.loc[units_in_g[0]]
-            # ^ that line arbitrarily chooses the first row that has the bi_val so
-            # the first row of that group.
-            group_covs = []
-            for col in return_groups.columns:
-                if col in covs_match_on:
-                    group_covs.append(temp_row_in_group[col])
-                else:
-                    group_covs.append('*')
-            # add that group to the newly matched units to our new dataframe
-
-            return_groups.loc[newly_matched, :] = group_covs
-
-            # other idea for this step of algorithm:
-            # store the bi in a column with df_all and also a column for "pair" with another
-            # persons unit id.
-            # don't update that when someone gets added to an auxiliary matched group
-            # then at the end, iterate through it and create the nicely formatted output.
-
-    return matched_rows, return_groups, all_units_in_g
+    # These are the rows of data, and the units, that have been matched:
+    matched_rows = np.flatnonzero(matched)
+    matched_units = data.units[matched_rows]
+
+    # bi holds dense group ids, and a group is matched when it has both
+    # treated and control units.
+    is_matched_group = (n_treated > 0) & (n_control > 0)
+    matched_counts = (n_treated[is_matched_group], n_control[is_matched_group])
+
+    # Sort the matched rows by group, keeping the order of the rows within a
+    # group, and find where each group starts.
+    order = np.argsort(bi, kind='stable')
+    sorted_bi = bi[order]
+    starts = np.flatnonzero(np.diff(sorted_bi, prepend=-1))
+    units_sorted = data.units[matched_rows[order]]
+
+    # Only the groups with a unit that hasn't been matched yet are returned.
+    # For those units, this is their main matched group.
+    newly_matched = unmatched[units_sorted]
+    has_new = np.zeros(len(starts), dtype=bool)
+    if len(starts):
+        has_new = np.add.reduceat(newly_matched, starts) > 0
+
+    # Each group holds the unit ids of all of the units in that group
+    sizes = np.diff(np.append(starts, len(units_sorted)))
+    group_of_row = np.repeat(np.arange(len(starts)), sizes)
+    units_in_g = units_sorted[has_new[group_of_row]]
+    all_units_in_g = MatchedGroups.from_flat(data.index.values[units_in_g],
+                                             sizes[has_new])
+
+    # What does each group look like? eg [1,2,*,1]. All units of a group have
+    # the same values on cols, so the newly matched units only need to record
+    # that their main matched group was formed on cols. Every unit in these
+    # groups is in one more matched group.
+    if len(all_units_in_g):
+        return_groups.add(units_sorted[newly_matched], cols, units_in_g)
+
+    return matched_units, return_groups, all_units_in_g, matched_counts
+
+
+def count_matches(data, covs_match_on, group_by_engine='hash', keys=None,
+                  patterns=None):
+    '''
+    Counts the units of the matched groups that algo2_GroupedMR would form on
+    covs_match_on, without forming them, eg to score a covariate set.
+
+    Input:
+        data, covs_match_on, group_by_engine, keys, patterns: as in
+            algo2_GroupedMR.
+    Output:
+        matched_counts: tuple of arrays, the number of treated and of control
+            units in each matched group
+    '''
+    cols = sorted(data.columns(covs_match_on))
+
+    if patterns is not None:
+        _, _, n_treated, n_control = patterns.group(cols, keys)
+    else:
+        if keys is None:
+            keys = flame_group_by.encode_keys(
+                data.codes, data.cardinalities[cols], cols)
+        bi, num_groups = flame_group_by.group_ids(keys, group_by_engine)
+        n_treated, n_control = flame_group_by.group_counts(
+            bi, num_groups, data.treated)
+
+    is_matched_group = (n_treated > 0) & (n_control > 0)
+    return n_treated[is_matched_group], n_control[is_matched_group]
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""Compact storage of the units of every matched group"""
+
+# Copyright Duke University 2020
+# License: MIT
+
+import copy
+
+import numpy as np
+import pandas as pd
+
+
+class MatchedGroups:
+    '''
+    The unit ids of every matched group, stored CSR-style: one flat array of
+    unit ids, and the offset where each group starts in it, along with the
+    iteration in which each group was formed.
+
+    It can be used as the list of lists of unit ids it replaces: len(),
+    indexing and iterating give lists of unit ids, and groups are added with
+    + and +=. Appending grows the arrays geometrically, so it is amortized
+    O(1) per unit.
+
+    Attributes (read only):
+        units: array, the unit ids of all groups, one group after the other.
+        offsets: array, length number of groups + 1. Group g is
+            units[offsets[g]:offsets[g + 1]].
+        iterations: array, the iteration in which each group was formed.
+    '''
+    def __init__(self, groups=(), iteration=0):
+        self._units = np.empty(0, dtype=np.int64)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._iterations = np.empty(0, dtype=np.int64)
+        self._num_units = 0
+        self._num_groups = 0
+        groups = list(groups)
+        if groups:
+            sizes = [len(group) for group in groups]
+            units = np.concatenate([np.asarray(group) for group in groups])
+            self.append(units, sizes, iteration)
+
+    @classmethod
+    def from_flat(cls, units, sizes, iteration=0):
+        '''
+        Makes the groups from the flat array of their unit ids and the
+        number of units in each group.
+        '''
+        matched_groups = cls()
+        matched_groups.append(units, sizes, iteration)
+        return matched_groups
+
+    @staticmethod
+    def _reserve(arr, length, dtype):
+        '''Returns arr, or a copy with at least the given capacity'''
+        try:
+            dtype = np.result_type(arr.dtype, dtype)
+        except TypeError:
+            # eg string unit ids after integer ones
+            dtype = np.dtype(object)
+        if length <= len(arr) and dtype == arr.dtype:
+            return arr
+        new_arr = np.empty(max(length, 2 * len(arr)), dtype=dtype)
+        new_arr[:len(arr)] = arr
+        return new_arr
+
+    def append(self, units, sizes, iteration=0):
+        '''
+        Adds groups at the end.
+
+        Input:
+            units: the unit ids of the new groups, one group after the other.
+            sizes: the number of units in each new group.
+            iteration (int, array): the iteration of the new groups.
+        '''
+        units = np.asarray(units)
+        if not len(units):
+            units = units.astype(self._units.dtype)
+        sizes = np.asarray(sizes, dtype=np.int64)
+        num_units = self._num_units + len(units)
+        num_groups = self._num_groups + len(sizes)
+
+        self._units = self._reserve(self._units, num_units, units.dtype)
+        self._units[self._num_units:num_units] = units
+        self._offsets = self._reserve(self._offsets, num_groups + 1,
+                                      np.int64)
+        self._offsets[self._num_groups + 1:num_groups + 1] = \
+            self._num_units + np.cumsum(sizes)
+        self._iterations = self._reserve(self._iterations, num_groups,
+                                         np.int64)
+        self._iterations[self._num_groups:num_groups] = iteration
+
+        self._num_units = num_units
+        self._num_groups = num_groups
+
+    def extend(self, other, iteration=None):
+        '''
+        Adds the groups of other at the end, with their own iterations, or
+        with the given iteration.
+        '''
+        if not isinstance(other, MatchedGroups):
+            other = MatchedGroups(other)
+        if iteration is None:
+            iteration = other.iterations
+        self.append(other.units, other.sizes(), iteration)
+
+    @property
+    def units(self):
+        return self._units[:self._num_units]
+
+    @property
+    def offsets(self):
+        return self._offsets[:self._num_groups + 1]
+
+    @property
+    def iterations(self):
+        return self._iterations[:self._num_groups]
+
+    def sizes(self):
+        '''The number of units in each group'''
+        return np.diff(self.offsets)
+
+    def group_ids(self):
+        '''The group of every element of units'''
+        return np.repeat(np.arange(self._num_groups), self.sizes())
+
+    def main_groups(self):
+        '''
+        The main matched group of every matched unit, which is the first
+        group it is in.
+
+        Output:
+            unit_ids: array of the unique unit ids, in the order in which
+                they first appear
+            groups: array, the main matched group of each of them
+        '''
+        unit_ids, first = np.unique(self.units, return_index=True)
+        order = np.argsort(first, kind='stable')
+        groups = np.searchsorted(self.offsets, first[order], side='right') - 1
+        return unit_ids[order], groups
+
+    def __len__(self):
+        return self._num_groups
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[g] for g in range(*key.indices(self._num_groups))]
+        if key < 0:
+            key += self._num_groups
+        if not 0 <= key < self._num_groups:
+            raise IndexError('matched group index out of range')
+        return self._units[self._offsets[key]:self._offsets[key + 1]].tolist()
+
+    def __iter__(self):
+        offsets = self.offsets
+        for g in range(self._num_groups):
+            yield self._units[offsets[g]:offsets[g + 1]].tolist()
+
+    def __add__(self, other):
+        new_groups = MatchedGroups()
+        new_groups.extend(self)
+        new_groups.extend(other)
+        return new_groups
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and \
+                all(list(a) == list(b) for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class MatchedPatterns:
+    '''
+    The covariate values that every matched unit was matched on in its main
+    matched group. The values are kept as the covariate codes of all units,
+    and each matched unit records which covariate set its main matched group
+    was formed on. The DataFrame of values with "*"s for the covariates not
+    matched on is only made by to_frame().
+
+    Attributes:
+        covs (list): the covariate names.
+        index: the unit ids, as in the input data.
+        codes, uniques: the covariate codes of every unit, and the value of
+            each code, as in CompactCovariates.
+        covs_sets: boolean array, one row for each covariate set that units
+            were matched on, True for the covariates in it.
+        unit_set: for every unit, the row of covs_sets its main matched group
+            was formed on, or -1 if it has not been matched.
+        weights: array, the number of matched groups every unit is in.
+    '''
+    def __init__(self, data):
+        self.covs = list(data.covs)
+        self.index = data.index
+        self.codes = data.codes
+        self.uniques = data.uniques
+        self.covs_sets = np.zeros((0, len(self.covs)), dtype=bool)
+        self.unit_set = np.full(len(self.index), -1, dtype=np.int32)
+        self.weights = np.zeros(len(self.index))
+
+    def copy(self):
+        '''A copy that can be matched on without changing this one'''
+        new_patterns = copy.copy(self)
+        new_patterns.unit_set = self.unit_set.copy()
+        new_patterns.weights = self.weights.copy()
+        return new_patterns
+
+    def add(self, units, cols, group_units):
+        '''
+        Records new matched groups formed on the covariates in the given
+        columns.
+
+        Input:
+            units: positions of the units for which this is the main matched
+                group.
+            cols: the columns the groups were formed on.
+            group_units: positions of all of the units in the new groups,
+                each unit at most once.
+        '''
+        covs_set = np.zeros((1, len(self.covs)), dtype=bool)
+        covs_set[0, cols] = True
+        self.covs_sets = np.concatenate([self.covs_sets, covs_set])
+        self.unit_set[units] = len(self.covs_sets) - 1
+        # The groups of one match do not overlap, so no unit is repeated.
+        self.weights[group_units] += 1
+
+    def matched_units(self):
+        '''The positions of the matched units'''
+        return np.flatnonzero(self.unit_set >= 0)
+
+    def matched_index(self):
+        '''The unit ids of the matched units'''
+        return self.index[self.matched_units()]
+
+    def covs_matched_on(self, unit_id):
+        '''
+        The names of the covariates the main matched group of a unit was
+        formed on, or None if the unit has not been matched.
+        '''
+        position = self.index.get_indexer([unit_id])[0]
+        if position < 0 or self.unit_set[position] < 0:
+            return None
+        covs_set = self.covs_sets[self.unit_set[position]]
+        return [cov for cov, in_set in zip(self.covs, covs_set) if in_set]
+
+    def unit_weights(self):
+        '''The number of matched groups of every matched unit, as a Series'''
+        units = self.matched_units()
+        return pd.Series(self.weights[units], index=self.index[units],
+                         name='weights')
+
+    def to_frame(self, weights=False):
+        '''
+        The DataFrame of the matched units with the covariate values of their
+        main matched group, and "*" for the covariates it was not formed on.
+        Optionally with the weights column of each unit.
+        '''
+        units = self.matched_units()
+        in_set = self.covs_sets[self.unit_set[units]]
+        values = np.full((len(units), len(self.covs)), '*', dtype=object)
+        for col in range(len(self.covs)):
+            rows = np.flatnonzero(in_set[:, col])
+            values[rows, col] = \
+                self.uniques[col][self.codes[units[rows], col]]
+        df = pd.DataFrame(values, index=self.index[units], columns=self.covs)
+        if weights:
+            df['weights'] = self.weights[units]
+        return df
+
+    def combine(self, other):
+        '''
+        The matches of this run, followed by those of other, a run on some
+        of the same units and covariates, as done when FLAME hands off to
+        DAME. Units keep their first main matched group, and the number of
+        groups they are in is added up.
+        '''
+        new_patterns = self.copy()
+        units = self.index.get_indexer(other.index)
+        cols = [self.covs.index(cov) for cov in other.covs]
+        covs_sets = np.zeros((len(other.covs_sets), len(self.covs)),
+                             dtype=bool)
+        covs_sets[:, cols] = other.covs_sets
+        other_set = np.where(other.unit_set >= 0,
+                             other.unit_set + len(self.covs_sets), -1)
+        new_patterns.covs_sets = np.concatenate([self.covs_sets, covs_sets])
+        first = new_patterns.unit_set[units] < 0
+        new_patterns.unit_set[units[first]] = other_set[first]
+        new_patterns.weights[units] += other.weights
+        return new_patterns
@@ -22,8 +22,9 @@ class MatchParent:
 
     Parameters
     -----------
-    adaptive_weights (bool, str): Weight dropping method. False, 'ridge',
-        'decisiontree', 'ridgeCV', or 'decisiontreeCV'.
+    adaptive_weights (bool, str, object): Weight dropping method. False,
+        'ridge', 'decisiontree', 'ridgeCV', 'decisiontreeCV', a scikit-learn
+        estimator, or a flame_dame_helpers.PEEngine subclass.
     alpha (float): This is the alpha for ridge regression. We use the
         scikit package for ridge regression, so it is "regularization
         strength". Larger values specify stronger regularization.
@@ -65,6 +66,29 @@ class MatchParent:
         predictive error of the covariate sets matched on in each iteration
     want_bf: whether the output will include the balancing factor of each
         iteration.
+    group_by_engine ('hash', 'sort', 'rollup'): default 'hash'. The backend
+        used to form matched groups. 'hash' assigns groups in a single pass,
+        'sort' is the reference implementation built on sorting, kept so the
+        two can be compared. 'rollup' groups the distinct covariate patterns
+        of the units instead of the units, which is faster when many units
+        share a pattern.
+    n_jobs (int): default 1. The number of workers used to score, at the
+        same time, the covariates FLAME could drop next, or the covariate
+        sets that DAME makes eligible to drop in an iteration. -1 means all
+        cores. The matches are the same for any value.
+    successive_halving (bool, int): default False. If an int, the
+        predictive errors of the covariate sets are first estimated on a
+        sample of that many holdout units of each treatment arm, doubled
+        each round, and the sets that are clearly worse than the best one
+        are ruled out before the full holdout is used. Their number is
+        counted in pe_cache.avoided.
+
+    Attributes
+    -----------
+    pe_cache (PECache): the predictive errors of the covariate sets computed
+        by this object. They are reused in later calls to predict() with the
+        same holdout data and adaptive_weights, and its hits and misses
+        count how many were reused or computed.
     """
     def __init__(self, adaptive_weights='ridge', alpha=0.1, repeats=True,
                  verbose=2, early_stop_iterations=float('inf'),
@@ -73,7 +97,8 @@ class MatchParent:
                  early_stop_pe=0.05,
                  missing_indicator=np.nan, missing_data_replace=0,
                  missing_holdout_replace=0, missing_holdout_imputations=10,
-                 missing_data_imputations=1, want_pe=False, want_bf=False):
+                 missing_data_imputations=1, want_pe=False, want_bf=False,
+                 group_by_engine='hash', n_jobs=1, successive_halving=False):
 
         self.adaptive_weights = adaptive_weights
         self.alpha = alpha
@@ -92,6 +117,10 @@ class MatchParent:
         self.early_stop_pe = early_stop_pe
         self.want_pe = want_pe
         self.want_bf = want_bf
+        self.group_by_engine = group_by_engine
+        self.n_jobs = n_jobs
+        self.successive_halving = successive_halving
+        self.pe_cache = flame_dame_helpers.PECache()
 
     def fit(self, holdout_data=False, treatment_column_name='treated',
             outcome_column_name='outcome', weight_array=False):
@@ -152,16 +181,18 @@ class DAME(MatchParent):
             self.want_bf,
             self.missing_indicator,
             self.missing_data_replace, self.missing_holdout_replace,
-            self.missing_holdout_imputations, self.missing_data_imputations)
+            self.missing_holdout_imputations, self.missing_data_imputations,
+            self.group_by_engine, self.n_jobs, self.pe_cache,
+            self.successive_halving)
 
         self.bf_each_iter = None
         self.pe_each_iter = None
 
         # in the non-mice case:
         if (self.missing_data_replace != 3):
-            self.df_units_and_covars_matched = return_array[0]
-            self.groups_per_unit = self.df_units_and_covars_matched['weights']
-            self.df_units_and_covars_matched = self.df_units_and_covars_matched.drop(columns = ['weights'])
+            self.matched_patterns = return_array[0]
+            self.df_units_and_covars_matched = self.matched_patterns.to_frame()
+            self.groups_per_unit = self.matched_patterns.unit_weights()
             self.units_per_group = return_array[1]
             if self.want_pe:
                 self.pe_each_iter = return_array[2]
@@ -169,14 +200,16 @@ class DAME(MatchParent):
                 self.bf_each_iter = return_array[-1]
         else:
             # in the mice case:
+            array_of_patterns = []
             array_of_dfs = []
             array_of_groups_per_unit = []
             array_of_units_per_group = []
             for arr in return_array:
-                temp_df = arr[0]
-                array_of_groups_per_unit.append(temp_df['weights'])
-                array_of_dfs.append(temp_df.drop(columns=['weights']))
+                array_of_patterns.append(arr[0])
+                array_of_groups_per_unit.append(arr[0].unit_weights())
+                array_of_dfs.append(arr[0].to_frame())
                 array_of_units_per_group.append(arr[1])
+            self.matched_patterns = array_of_patterns
             self.groups_per_unit = array_of_groups_per_unit
             self.df_units_and_covars_matched = array_of_dfs
             self.units_per_group = array_of_units_per_group
@@ -213,26 +246,23 @@ class FLAME(MatchParent):
             self.want_bf, self.missing_indicator,
             self.missing_data_replace, self.missing_holdout_replace,
             self.missing_holdout_imputations, self.missing_data_imputations,
-            pre_dame, C)
+            pre_dame, C, self.group_by_engine, self.n_jobs, self.pe_cache,
+            self.successive_halving)
 
         self.bf_each_iter = None
         self.pe_each_iter = None
 		
-        # in the non-mice case:
-        if self.missing_data_replace != 3 and pre_dame == float('inf'):
-            self.df_units_and_covars_matched = return_array[0]
-            self.groups_per_unit = self.df_units_and_covars_matched['weights']
-            self.df_units_and_covars_matched = self.df_units_and_covars_matched.drop(columns=['weights'])
-            self.units_per_group = return_array[1]
-            if self.want_pe:
-                self.pe_each_iter = return_array[2]
-            if self.want_bf:
-                self.bf_each_iter = return_array[-1]
+        # FLAME may match every unit before it gets to DAME, and then there
+        # are no DAME results to add on
+        if (self.missing_data_replace != 3 and pre_dame < float('inf') and
+                len(return_array) == 2 + bool(self.want_pe) + bool(self.want_bf)):
+            pre_dame = float('inf')
 
+        # in the non-mice case:
         if (self.missing_data_replace != 3 and pre_dame == float('inf')):
-            self.df_units_and_covars_matched = return_array[0]
-            self.groups_per_unit = self.df_units_and_covars_matched['weights']
-            self.df_units_and_covars_matched = self.df_units_and_covars_matched.drop(columns = ['weights'])
+            self.matched_patterns = return_array[0]
+            self.df_units_and_covars_matched = self.matched_patterns.to_frame()
+            self.groups_per_unit = self.matched_patterns.unit_weights()
             self.units_per_group = return_array[1]
             if (self.want_pe == True):
                 self.pe_each_iter = return_array[2]
@@ -242,29 +272,9 @@ class FLAME(MatchParent):
         elif pre_dame < float('inf'):
 
             # the first few items all look the same, then the last item is from dame
-            self.df_units_and_covars_matched = return_array[0]
-            # self.df_units_and_covars_matched = self.df_units_and_covars_matched.append(return_array[-1][0], sort=True)
-            self.df_units_and_covars_matched = pd.concat([self.df_units_and_covars_matched, return_array[-1][0]])
-
-            if self.repeats == True:
-                # we have to aggregate the indexes appearing more than once,
-                # those are the ones which were matched units in both dame and flame:
-
-                df_wrepeats = self.df_units_and_covars_matched
-                # this is a df without repeat indexes
-                df_no_repeats = df_wrepeats[~df_wrepeats.index.duplicated(keep='first')].copy()
-
-                #iterate through repeat indexes and sum weight column
-                matched_twice_ind = df_wrepeats[df_wrepeats.index.duplicated()].index.unique()
-                for index in matched_twice_ind:
-                    df_no_repeats.loc[index, 'weights'] = df_wrepeats.loc[index].copy()['weights'].sum()
-
-                self.df_units_and_covars_matched = df_no_repeats
-
-            self.df_units_and_covars_matched.replace(np.nan, "*")
-            self.groups_per_unit = self.df_units_and_covars_matched['weights']
-
-            self.df_units_and_covars_matched = self.df_units_and_covars_matched.drop(columns = ['weights'])
+            self.matched_patterns = return_array[0].combine(return_array[-1][0])
+            self.df_units_and_covars_matched = self.matched_patterns.to_frame()
+            self.groups_per_unit = self.matched_patterns.unit_weights()
             self.units_per_group = return_array[1]
             self.units_per_group += return_array[-1][1]
             if (self.want_pe == True):
@@ -277,15 +287,16 @@ class FLAME(MatchParent):
         else:
             # This is the mice case, where we have multiple return values.
             # We leave those as arrays.
-            self.df_units_and_covars_matched = []
+            self.matched_patterns = []
             self.groups_per_unit = []
             self.df_units_and_covars_matched = []
             self.units_per_group = []
             self.pe_each_iter = []
             self.bf_each_iter = []
             for return_val in return_array:
-                self.df_units_and_covars_matched.append(return_val[0].drop(columns = ['weights']))
-                self.groups_per_unit.append(return_val[0]['weights'])
+                self.matched_patterns.append(return_val[0])
+                self.df_units_and_covars_matched.append(return_val[0].to_frame())
+                self.groups_per_unit.append(return_val[0].unit_weights())
                 self.units_per_group.append(return_val[1])
                 if self.want_pe:
                     self.pe_each_iter.append(return_val[2])
@@ -304,18 +315,20 @@ def _DAME(df, df_holdout, treatment_column_name='treated', weight_array=False,
           early_stop_un_t_frac=False, early_stop_pe=0.05,
           want_bf=False, missing_indicator=np.nan,
           missing_data_replace=0, missing_holdout_replace=0,
-          missing_holdout_imputations=10, missing_data_imputations=1):
+          missing_holdout_imputations=10, missing_data_imputations=1,
+          group_by_engine='hash', n_jobs=1, pe_cache=None,
+          successive_halving=False):
     """ Accepts user input, validates, error-checks, calls DAME algorithm.
 
     Args:
         See description in MatchParent class above.
 
     Returns:
-        return_df: df of units with the column values of their main matched
-            group, with "*"s in place for the columns not in their MMG;
-            includes a unit weights column which indicates the number of times
-            each unit was matched
-        MG_units: list of unit ids for every matched group
+        return_matches (MatchedPatterns): the column values of the main
+            matched group of every unit, and the number of times each unit
+            was matched. Its to_frame() is the df of matched units, with
+            "*"s in place for the columns not in their MMG
+        MG_units (MatchedGroups): unit ids for every matched group
         pe_array: If want_pe is true, then the PE values of each match
         bf_array: If want_bf is true, then the BF values of each match
 
@@ -327,7 +340,10 @@ def _DAME(df, df_holdout, treatment_column_name='treated', weight_array=False,
                                           outcome_column_name)
 
     data_cleaning.check_parameters(adaptive_weights, df_holdout, df,
-                                   alpha, False, weight_array)
+                                   alpha, False, weight_array,
+                                   group_by_engine=group_by_engine,
+                                   n_jobs=n_jobs,
+                                   successive_halving=successive_halving)
 
     df, df_holdout, mice_on_match, mice_on_hold = data_cleaning.check_missings(
         df, df_holdout, missing_indicator, missing_data_replace,
@@ -344,7 +360,8 @@ def _DAME(df, df_holdout, treatment_column_name='treated', weight_array=False,
         return dame_algorithm.algo1(
             df, treatment_column_name, weight_array, outcome_column_name,
             adaptive_weights, alpha, df_holdout, repeats, want_pe, verbose,
-            want_bf, mice_on_hold, early_stops)
+            want_bf, mice_on_hold, early_stops, group_by_engine, pe_cache,
+            successive_halving=successive_halving, n_jobs=n_jobs)
 
     # if the 'if' condition is not true, this would mean we need to run mice on
     # the matching data, which means that we have to run algo1 multiple times
@@ -361,7 +378,9 @@ def _DAME(df, df_holdout, treatment_column_name='treated', weight_array=False,
         return_array.append(dame_algorithm.algo1(
             df_array[i], treatment_column_name, weight_array,
             outcome_column_name, adaptive_weights, alpha, df_holdout,
-            repeats, want_pe, verbose, want_bf, mice_on_hold, early_stops))
+            repeats, want_pe, verbose, want_bf, mice_on_hold, early_stops,
+            group_by_engine, pe_cache,
+            successive_halving=successive_halving, n_jobs=n_jobs))
     return return_array
 
 
@@ -375,7 +394,8 @@ def _FLAME(df, df_holdout, treatment_column_name='treated', weight_array=False,
            missing_indicator=np.nan,
            missing_data_replace=0, missing_holdout_replace=0,
            missing_holdout_imputations=10, missing_data_imputations=0,
-           pre_dame=float('inf'), C=0.1):
+           pre_dame=float('inf'), C=0.1, group_by_engine='hash', n_jobs=1,
+           pe_cache=None, successive_halving=False):
     """ This function kicks off the FLAME algorithm.
 
     Args:
@@ -385,6 +405,9 @@ def _FLAME(df, df_holdout, treatment_column_name='treated', weight_array=False,
         pre_dame (int, float): Indicates whether to switch to dame and after
             int number of iterations. A value of float('inf') (default) means only FLAME is run.
         C (float, 0.1): The tradeoff between PE and BF in computing MQ
+        n_jobs (int, 1): The number of workers scoring candidate covariates
+        pe_cache (PECache, None): The PEs computed in earlier runs, shared
+            with this one
 
 
     Returns:
@@ -395,7 +418,9 @@ def _FLAME(df, df_holdout, treatment_column_name='treated', weight_array=False,
         df, treatment_column_name, outcome_column_name)
 
     data_cleaning.check_parameters(
-        adaptive_weights, df_holdout, df, alpha, True, weight_array, C)
+        adaptive_weights, df_holdout, df, alpha, True, weight_array, C,
+        group_by_engine=group_by_engine, n_jobs=n_jobs,
+        successive_halving=successive_halving)
 
     df, df_holdout, mice_on_match, mice_on_hold = data_cleaning.check_missings(
         df, df_holdout, missing_indicator, missing_data_replace,
@@ -412,7 +437,8 @@ def _FLAME(df, df_holdout, treatment_column_name='treated', weight_array=False,
         return_array = flame_algorithm.flame_generic(
             df, treatment_column_name, weight_array, outcome_column_name,
             adaptive_weights, alpha, df_holdout, repeats, want_pe, verbose,
-            want_bf, mice_on_hold, early_stops, pre_dame, C)
+            want_bf, mice_on_hold, early_stops, pre_dame, C, group_by_engine,
+            n_jobs, pe_cache, successive_halving)
 
     else:
         # this would mean we need to run mice on the matching data, which means
@@ -436,6 +462,7 @@ def _FLAME(df, df_holdout, treatment_column_name='treated', weight_array=False,
             return_array.append(flame_algorithm.flame_generic(
                 df_array[i], treatment_column_name, weight_array, outcome_column_name,
                 adaptive_weights, alpha, df_holdout, repeats, want_pe, verbose,
-                want_bf, mice_on_hold, early_stops, pre_dame, C))
+                want_bf, mice_on_hold, early_stops, pre_dame, C,
+                group_by_engine, n_jobs, pe_cache, successive_halving))
 
     return return_array
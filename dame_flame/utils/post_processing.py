@@ -8,6 +8,7 @@
 
 import numpy as np
 from .. import matching
+from ..matched_groups import MatchedGroups
 
 def validate_matching_obj(matching_object):
     """ Check matching_object's type and that .fit(), .predict() done"""
@@ -18,7 +19,17 @@ def validate_matching_obj(matching_object):
     if (not hasattr(matching_object, 'input_data')):
         raise Exception("This function can be only called after a match has "\
                        "been formed using the .fit() and .predict() functions")
-            
+
+def main_group_of_units(array_mgs):
+    '''
+    Maps the unit id of every matched unit to the index of its main matched
+    group in array_mgs, a MatchedGroups or a list of lists of unit ids.
+    '''
+    if not isinstance(array_mgs, MatchedGroups):
+        array_mgs = MatchedGroups(array_mgs)
+    unit_ids, groups = array_mgs.main_groups()
+    return dict(zip(unit_ids.tolist(), groups.tolist()))
+
 def all_MGs(matching_object):
     '''
     This function returns all of the main matched groups, for every unit.
@@ -26,15 +37,10 @@ def all_MGs(matching_object):
     only specific units.
     '''
     validate_matching_obj(matching_object)
-    
-    mgs_dict = dict()
-    
-    for group in matching_object.units_per_group:
-        for index in group:
-            if index not in mgs_dict:
-                mgs_dict[index] = group
-                
-    return mgs_dict
+
+    array_mgs = matching_object.units_per_group
+    return {unit: array_mgs[group] for unit, group in
+            main_group_of_units(array_mgs).items()}
 
 
 def MG(matching_object, unit_ids, output_style=1, mice_iter=0):
@@ -59,29 +65,29 @@ def MG(matching_object, unit_ids, output_style=1, mice_iter=0):
 
     if (matching_object.missing_data_replace != 3):
         array_mgs = matching_object.units_per_group
-        df_matched_units = matching_object.df_units_and_covars_matched
+        matched_patterns = matching_object.matched_patterns
     else:
         array_mgs = matching_object.units_per_group[mice_iter]
-        df_matched_units = matching_object.df_units_and_covars_matched[mice_iter]
+        matched_patterns = matching_object.matched_patterns[mice_iter]
 
     main_matched_groups = []
+    # The first group to contain a unit is its MMG
+    mmg_of_unit = main_group_of_units(array_mgs)
 
     # Now we recover MMG
     for unit in unit_ids:
-        if unit in df_matched_units.index:
-            # Iterate through all matched groups
-            for group in array_mgs:
-                # The first group to contain the specified unit is the MMG
-                if unit in group:
-                    new_group = matching_object.input_data.loc[group]
-                    my_series = df_matched_units.loc[unit]
-                    if output_style == 1 and "*" in my_series.unique():
-                        # Insert asterisks for unused covariates
-                        star_cols = my_series[my_series == "*"].index
-                        for col in star_cols:
-                            new_group[col] = ["*"] * len(new_group.index)
-                    main_matched_groups.append(new_group)
-                    break
+        covs_matched_on = matched_patterns.covs_matched_on(unit)
+        if covs_matched_on is not None:
+            if unit in mmg_of_unit:
+                group = array_mgs[mmg_of_unit[unit]]
+                new_group = matching_object.input_data.loc[group]
+                if output_style == 1:
+                    # Insert asterisks for unused covariates
+                    star_cols = [col for col in matched_patterns.covs
+                                 if col not in covs_matched_on]
+                    for col in star_cols:
+                        new_group[col] = ["*"] * len(new_group.index)
+                main_matched_groups.append(new_group)
         # Warn user if a unit has no matches
         else:
             main_matched_groups.append(np.nan)
@@ -114,23 +120,22 @@ def CATE(matching_object, unit_ids, mice_iter=0):
 
 
     if (matching_object.missing_data_replace != 3):
-        arr_matched_groups = matching_object.units_per_group        
-        df_matched_units = matching_object.df_units_and_covars_matched
+        arr_matched_groups = matching_object.units_per_group
+        matched_patterns = matching_object.matched_patterns
     else:
         arr_matched_groups = matching_object.units_per_group[mice_iter]
-        df_matched_units = matching_object.df_units_and_covars_matched[mice_iter]
+        matched_patterns = matching_object.matched_patterns[mice_iter]
 
     # Recover CATEs
     cates = []
+    # The first group to contain a unit is its MMG
+    mmg_of_unit = main_group_of_units(arr_matched_groups)
     for unit in unit_ids:
-        if unit in df_matched_units.index:
-            for group in arr_matched_groups:
-                # The first group to contain the specified unit is the MMG
-                if unit in group:
-                    df_mmg = matching_object.input_data.loc[group, 
-                        [matching_object.treatment_column_name,
-                         matching_object.outcome_column_name]]
-                    break
+        if matched_patterns.covs_matched_on(unit) is not None:
+            group = arr_matched_groups[mmg_of_unit[unit]]
+            df_mmg = matching_object.input_data.loc[group,
+                [matching_object.treatment_column_name,
+                 matching_object.outcome_column_name]]
             # Assuming an MMG has been found, compute CATE for that group
             treated = df_mmg.loc[df_mmg[matching_object.treatment_column_name] == 1]
             control = df_mmg.loc[df_mmg[matching_object.treatment_column_name] == 0]
@@ -169,31 +174,41 @@ def ATE(matching_object, mice_iter=0):
         arr_matched_groups = matching_object.units_per_group[mice_iter]
         num_groups_per_unit = matching_object.groups_per_unit[mice_iter]
 
-    # Recover CATEs
-    cates = [0] * len(arr_matched_groups) # this will be a CATE for each matched group
-    for group_id in range(len(arr_matched_groups)):
-        group_data = matching_object.input_data.loc[arr_matched_groups[group_id],
-                                                    [matching_object.treatment_column_name,
-                                                     matching_object.outcome_column_name]]
-        treated = group_data.loc[group_data[matching_object.treatment_column_name] == 1]
-        control = group_data.loc[group_data[matching_object.treatment_column_name] == 0]
-        try:
-            avg_treated = sum(treated[matching_object.outcome_column_name]) / len(treated.index)
-            avg_control = sum(control[matching_object.outcome_column_name]) / len(control.index)
-        except:
-            print("There was an error in the matching process.", group_id)
-            break
-        cates[group_id] = avg_treated - avg_control
+    if not isinstance(arr_matched_groups, MatchedGroups):
+        arr_matched_groups = MatchedGroups(arr_matched_groups)
+    num_groups = len(arr_matched_groups)
+    group_of_unit = arr_matched_groups.group_ids()
+    group_data = matching_object.input_data.loc[arr_matched_groups.units,
+                                                [matching_object.treatment_column_name,
+                                                 matching_object.outcome_column_name]]
+    treatment = group_data[matching_object.treatment_column_name].to_numpy()
+    outcome = group_data[matching_object.outcome_column_name].to_numpy(dtype=float)
+
+    # Recover CATEs, one for each matched group, from the per group sums
+    # of the outcomes of its treated and control units
+    is_treated = treatment == 1
+    is_control = treatment == 0
+    num_treated = np.bincount(group_of_unit, weights=is_treated, minlength=num_groups)
+    num_control = np.bincount(group_of_unit, weights=is_control, minlength=num_groups)
+    sum_treated = np.bincount(group_of_unit, weights=outcome * is_treated,
+                              minlength=num_groups)
+    sum_control = np.bincount(group_of_unit, weights=outcome * is_control,
+                              minlength=num_groups)
+    cates = np.zeros(num_groups)
+    valid = (num_treated > 0) & (num_control > 0)
+    if not valid.all():
+        group_id = np.flatnonzero(~valid)[0]
+        print("There was an error in the matching process.", group_id)
+        valid[group_id:] = False
+    cates[valid] = (sum_treated[valid] / num_treated[valid] -
+                    sum_control[valid] / num_control[valid])
 
     # Compute ATE
-    weight_sum = 0
-    weighted_cate_sum = 0
-    for group_id in range(len(arr_matched_groups)):
-        matched_group_weight = 0
-        for unit in arr_matched_groups[group_id]:
-            matched_group_weight += num_groups_per_unit[unit]
-        weight_sum += matched_group_weight
-        weighted_cate_sum += matched_group_weight * cates[group_id]
+    unit_weights = num_groups_per_unit.loc[arr_matched_groups.units].to_numpy(dtype=float)
+    matched_group_weight = np.bincount(group_of_unit, weights=unit_weights,
+                                       minlength=num_groups)
+    weight_sum = matched_group_weight.sum()
+    weighted_cate_sum = (matched_group_weight * cates).sum()
 
     return weighted_cate_sum/weight_sum
 
@@ -215,11 +230,11 @@ def ATT(matching_object, mice_iter=0):
     if matching_object.missing_data_replace != 3:
         num_groups_per_unit = matching_object.groups_per_unit
         matched_df = matching_object.input_data.loc[
-            matching_object.df_units_and_covars_matched.index]
+            matching_object.matched_patterns.matched_index()]
     else:
         num_groups_per_unit = matching_object.groups_per_unit[mice_iter]
         matched_df = matching_object.input_data.loc[
-            matching_object.df_units_and_covars_matched[mice_iter].index]
+            matching_object.matched_patterns[mice_iter].matched_index()]
 
     treated = matched_df.loc[matched_df[matching_object.treatment_column_name] == 1]
     control = matched_df.loc[matched_df[matching_object.treatment_column_name] == 0]
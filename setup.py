@@ -18,6 +18,7 @@ setuptools.setup(name='flame_db',
       packages=setuptools.find_packages(),
       install_requires=[
           'scikit-learn>=0.21.3',
+          'joblib>=0.12',
           'scipy>=0.14',
           'pandas>=0.11.0',
           'numpy>=1.6.1'
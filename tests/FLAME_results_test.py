@@ -5,9 +5,13 @@
 # License: MIT
 
 from dame_flame import matching
+from dame_flame import flame_dame_helpers, flame_group_by, generate_new_active_sets
+from dame_flame import dame_algorithm, flame_algorithm, grouped_mr
+from dame_flame.matched_groups import MatchedGroups, MatchedPatterns
 from dame_flame.utils.data import *
 from dame_flame.utils.post_processing import *
 import unittest
+from sklearn.tree import DecisionTreeRegressor
 import pandas as pd
 import os
 import sys
@@ -315,7 +319,43 @@ class TestFlame(unittest.TestCase):
 
         self.assertEqual(1, is_correct,
                          msg='FLAME-Error when we use pre_dame')
-        
+
+    def test_pre_dame_matches_MG_F(self):
+        df, true_TE = generate_uniform_given_importance(num_control=150, num_treated=150,
+                                  num_cov=7, min_val=0,
+                                  max_val=3, covar_importance=[4,3,2,1,0,0,0])
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100,
+                                              num_cov=7, min_val=0,
+                                                  max_val=3, covar_importance=[4,3,2,1,0,0,0])
+        for repeats in [False, True]:
+            model = matching.FLAME(repeats=repeats, verbose=0, early_stop_pe=False)
+            model.fit(holdout_data=holdout)
+            output = model.predict(df, pre_dame=2)
+
+            # the output is the matched patterns, with "*"s for FLAME and DAME
+            self.assertFalse(output.isnull().values.any())
+            self.assertTrue(output.equals(model.matched_patterns.to_frame()))
+            self.assertTrue(model.groups_per_unit.equals(
+                model.matched_patterns.unit_weights()))
+
+            # and each unit has the covariate values of its main matched group
+            covs = list(output.columns)
+            for unit in output.index[::10]:
+                mmg = MG(model, unit)
+                self.assertEqual(mmg.loc[unit, covs].astype(str).tolist(),
+                                 output.loc[unit].astype(str).tolist())
+
+        # every unit has an exact match, so FLAME is done before DAME
+        df = pd.DataFrame({'x1': [0, 0, 1, 1], 'x2': [0, 0, 1, 1],
+                           'treated': [0, 1, 0, 1], 'outcome': [1, 2, 3, 5]})
+        outputs = []
+        for pre_dame in [float('inf'), 1]:
+            model = matching.FLAME(verbose=0, want_pe=True, early_stop_pe=False)
+            model.fit(holdout_data=df)
+            outputs.append(model.predict(df, pre_dame=pre_dame))
+            self.assertEqual(model.units_per_group, [[0, 1], [2, 3]])
+        self.assertTrue(outputs[0].equals(outputs[1]))
+
     def test_other_param_F(self):
         is_correct = 1
         try:
@@ -416,6 +456,19 @@ class TestFlame(unittest.TestCase):
 
         self.assertEqual(1, is_correct, msg='FLAME-Error when no matching')
 
+    def test_n_jobs_F(self):
+        df, true_TE = generate_uniform_given_importance(num_control=300, num_treated=300)
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
+        outputs = []
+        for n_jobs in [1, 2]:
+            model = matching.FLAME(verbose=0, n_jobs=n_jobs, want_pe=True)
+            model.fit(holdout_data=holdout)
+            outputs.append((model.predict(df), model.pe_each_iter))
+        self.assertTrue(outputs[0][0].equals(outputs[1][0]),
+                        msg='Matches depend on n_jobs')
+        self.assertEqual(outputs[0][1], outputs[1][1],
+                         msg='PEs depend on n_jobs')
+
 class TestDame(unittest.TestCase):
             
     def test_PE_F(self):
@@ -702,7 +755,22 @@ class TestDame(unittest.TestCase):
 
         self.assertEqual(1, is_correct, msg='DAME-Error when no matching')
 
+    def test_n_jobs_F(self):
+        df, true_TE = generate_uniform_given_importance(num_control=200, num_treated=200)
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
+        for adaptive_weights in ['ridge', DecisionTreeRegressor(random_state=0)]:
+            outputs = []
+            for n_jobs in [1, 2]:
+                model = matching.DAME(verbose=0, adaptive_weights=adaptive_weights,
+                                      want_pe=True, n_jobs=n_jobs)
+                model.fit(holdout_data=holdout)
+                outputs.append((model.predict(df), model.pe_each_iter))
+            self.assertTrue(outputs[0][0].equals(outputs[1][0]))
+            self.assertEqual(outputs[0][1], outputs[1][1])
 
+        self.assertEqual(flame_dame_helpers.run_parallel_batches(
+            pow, (2,), [(i,) for i in range(7)], 3, 'threads'),
+            [2 ** i for i in range(7)])
 
 class Test_exceptions(unittest.TestCase):
     
@@ -735,6 +803,18 @@ class Test_exceptions(unittest.TestCase):
                         'of proportion of unmatched treatment units needs to '\
                         'be between 0.0 and 1.0' in str(early_stop_un_t_frac.exception))
     
+    def test_false_n_jobs(self):
+        def broken_n_jobs():
+            df, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
+            model = matching.FLAME(n_jobs=0)
+            model.fit(holdout_data=df)
+            output = model.predict(df)
+
+        with self.assertRaises(Exception) as n_jobs:
+            broken_n_jobs()
+
+        self.assertTrue('The n_jobs must be a nonzero integer' in str(n_jobs.exception))
+
     def test_false_early_stop_un_c_frac(self):
         def broken_early_stop_un_c_frac():
             df, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
@@ -995,4 +1075,479 @@ class Test_exceptions(unittest.TestCase):
             broken_ATE_input_model()
         self.assertTrue("This function can be only called after a match has "\
                            "been formed using the .fit() and .predict() functions" in str(ATE_input_model.exception))
-                    
\ No newline at end of file
+                    
+
+class TestGroupBy(unittest.TestCase):
+
+    def test_wide_keys(self):
+        # 40 and 120 covariates overflow a single 64-bit mixed-radix key
+        rng = np.random.RandomState(0)
+        for num_cov, num_vals in [(3, 4), (40, 5), (120, 7)]:
+            df = pd.DataFrame(rng.randint(0, num_vals, size=(400, num_cov)),
+                              columns=[str(i) for i in range(num_cov)])
+            df = pd.concat([df, df], ignore_index=True)
+            df['treated'] = rng.randint(0, 2, size=len(df))
+            covs = [str(i) for i in range(num_cov)]
+
+            matched, group_ids, n_treated, n_control = flame_group_by.match_ng(
+                df[covs].values, range(num_cov), [num_vals] * num_cov,
+                df['treated'].values)
+
+            # a unit is matched iff its exact group has both treatments
+            groups = df.groupby(covs)['treated']
+            expected = ((groups.transform('min') == 0) &
+                        (groups.transform('max') == 1)).values
+            self.assertTrue((matched == expected).all(),
+                            msg='Wrong matches with {0} covariates'.format(num_cov))
+            self.assertEqual(len(np.unique(group_ids)),
+                             df[expected].groupby(covs).ngroups,
+                             msg='Wrong groups with {0} covariates'.format(num_cov))
+            self.assertEqual((n_treated.sum(), n_control.sum()),
+                             (df['treated'].sum(), (1 - df['treated']).sum()),
+                             msg='Wrong group counts with {0} covariates'.format(num_cov))
+
+    def test_engines_agree(self):
+        df, true_TE = generate_uniform_given_importance(num_control=500, num_treated=500)
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
+        for algo in [matching.FLAME, matching.DAME]:
+            for repeats in [True, False]:
+                outputs = []
+                for engine in flame_group_by.GROUP_BY_ENGINES:
+                    model = algo(verbose=0, group_by_engine=engine,
+                                 repeats=repeats, early_stop_iterations=3)
+                    model.fit(holdout_data=holdout)
+                    outputs.append((model.predict(df), model.units_per_group,
+                                    model.groups_per_unit))
+                for output in outputs[1:]:
+                    self.assertTrue(outputs[0][0].equals(output[0]),
+                                    msg='Engines disagree on matches')
+                    self.assertEqual(list(map(list, outputs[0][1])),
+                                     list(map(list, output[1])),
+                                     msg='Engines disagree on matched groups')
+                    self.assertTrue(outputs[0][2].equals(output[2]),
+                                    msg='Engines disagree on unit weights')
+
+    def test_derived_keys(self):
+        rng = np.random.RandomState(1)
+        for num_cov, num_vals in [(5, 3), (45, 5), (150, 6)]:
+            arr = rng.randint(0, num_vals, size=(300, num_cov))
+            arr = np.concatenate([arr, arr])
+            cols = list(range(num_cov))
+            keys = flame_group_by.MixedRadixKeys(arr, cols, [num_vals] * num_cov)
+            for drop in [0, num_cov // 2, num_cov - 1]:
+                rest = [col for col in cols if col != drop]
+                derived, num_derived = flame_group_by.group_ids(keys.drop(drop))
+                fresh, num_fresh = flame_group_by.group_ids(
+                    flame_group_by.encode_keys(arr, [num_vals] * len(rest), rest))
+                # both keys must split the units into the same groups
+                pairs = np.unique(np.stack([derived, fresh]), axis=1)
+                self.assertTrue(num_derived == num_fresh == pairs.shape[1],
+                                msg='Derived keys wrong with {0} covariates'.format(num_cov))
+
+    def test_matched_groups(self):
+        groups = [[0, 3], [0, 2, 3], [5]]
+        matched_groups = MatchedGroups(groups[:1])
+        for group in groups[1:]:
+            matched_groups.append(group, [len(group)], iteration=1)
+        self.assertEqual(matched_groups, groups)
+        self.assertEqual(list(matched_groups.offsets), [0, 2, 5, 6])
+        self.assertEqual(list(matched_groups.iterations), [0, 1, 1])
+        self.assertEqual(matched_groups[-1], [5])
+        matched_groups += [[7, 8]]
+        self.assertEqual(list(map(list, matched_groups)), groups + [[7, 8]])
+
+        df, true_TE = generate_uniform_given_importance(num_control=300, num_treated=300)
+        model = matching.FLAME(verbose=0)
+        model.fit(holdout_data=df)
+        model.predict(df)
+        # the estimators must agree with the list of lists they used to take
+        as_lists = list(map(list, model.units_per_group))
+        ate, cate = ATE(model), CATE(model, as_lists[0][0])
+        model.units_per_group = as_lists
+        self.assertAlmostEqual(ate, ATE(model))
+        self.assertAlmostEqual(cate, CATE(model, as_lists[0][0]))
+
+    def test_grouped_mr(self):
+        rng = np.random.RandomState(2)
+        df = pd.DataFrame(rng.randint(0, 3, size=(400, 4)),
+                          columns=['a', 'b', 'c', 'd'])
+        df['treated'] = rng.randint(0, 2, size=len(df))
+        df.index = rng.permutation(len(df)) + 1000
+        data = flame_dame_helpers.CompactCovariates(df, ['a', 'b', 'c', 'd'],
+                                                    'treated')
+        unmatched = rng.rand(len(df)) < 0.3
+        for engine in flame_group_by.GROUP_BY_ENGINES:
+            patterns = None
+            if engine == 'rollup':
+                patterns = flame_group_by.PatternTable(data, range(4))
+            for covs in [['a', 'b', 'c', 'd'], ['d', 'b'], ['c']]:
+                matched_units, return_groups, units_in_g, matched_counts = \
+                    grouped_mr.algo2_GroupedMR(
+                        data, unmatched, covs, MatchedPatterns(data), engine,
+                        patterns=patterns)
+
+                # the groups one at a time, as they used to be formed
+                expected = []
+                num_matched = 0
+                for _, group in df.groupby(covs):
+                    if group['treated'].nunique() < 2:
+                        continue
+                    num_matched += len(group)
+                    if unmatched[df.index.get_indexer(group.index)].any():
+                        expected.append(list(group.index))
+                self.assertEqual(sorted(map(list, units_in_g)), sorted(expected),
+                                 msg='Wrong groups with the {0} engine'.format(engine))
+                self.assertEqual(len(matched_units), num_matched)
+                self.assertEqual(matched_counts[0].sum() + matched_counts[1].sum(),
+                                 num_matched)
+                for unit in df.index[unmatched][:20]:
+                    in_group = any(unit in group for group in expected)
+                    self.assertEqual(return_groups.covs_matched_on(unit),
+                                     sorted(covs) if in_group else None)
+
+    def test_unit_weights(self):
+        df, true_TE = generate_uniform_given_importance(num_control=300, num_treated=300)
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
+        for model, pre_dame in [(matching.FLAME(verbose=0), None),
+                                (matching.FLAME(verbose=0, early_stop_pe=False), 2),
+                                (matching.DAME(verbose=0), None)]:
+            model.fit(holdout_data=holdout)
+            if pre_dame:
+                model.predict(df, pre_dame=pre_dame)
+            else:
+                model.predict(df)
+
+            # the weight of a unit is the number of matched groups it is in,
+            # as it was when the groups added to it one at a time
+            expected = pd.Series(0.0, index=df.index)
+            for group in model.units_per_group:
+                expected[list(group)] += 1
+            expected = expected[expected > 0]
+            weights = model.groups_per_unit
+            self.assertTrue(weights.sort_index().equals(
+                expected.rename('weights').sort_index()),
+                msg='Wrong unit weights with {0}'.format(type(model).__name__))
+
+    def test_candidate_counts(self):
+        rng = np.random.RandomState(3)
+        covs = ['a', 'b', 'c', 'd']
+        df = pd.DataFrame(rng.randint(0, 4, size=(500, 4)), columns=covs)
+        df['treated'] = rng.randint(0, 2, size=len(df))
+        data = flame_dame_helpers.CompactCovariates(df, covs, 'treated')
+        unmatched = np.ones(len(df), dtype=bool)
+        for engine in flame_group_by.GROUP_BY_ENGINES:
+            patterns = None
+            if engine == 'rollup':
+                patterns = flame_group_by.PatternTable(data, range(4))
+            codes = data.codes if patterns is None else patterns.codes
+            curr_keys = flame_group_by.MixedRadixKeys(
+                codes, range(4), data.cardinalities)
+            for poss_drop in covs:
+                counts = flame_algorithm.count_candidate_matches(
+                    data, curr_keys, covs, poss_drop, engine, patterns)
+                covs_match_on = [cov for cov in covs if cov != poss_drop]
+                self.assertEqual(
+                    [list(n) for n in counts],
+                    [list(n) for n in grouped_mr.count_matches(
+                        data, covs_match_on, engine, patterns=patterns)])
+
+                # the counts are those of the groups that are formed
+                _, _, units_in_g, matched_counts = grouped_mr.algo2_GroupedMR(
+                    data, unmatched, covs_match_on, MatchedPatterns(data),
+                    engine, patterns=patterns)
+                self.assertEqual([list(n) for n in counts],
+                                 [list(n) for n in matched_counts])
+                treated = df['treated'].values
+                group_counts = [(treated[group].sum(), len(group) - treated[group].sum())
+                                for group in map(list, units_in_g)]
+                self.assertEqual(list(zip(*counts)), group_counts,
+                                 msg='Wrong counts without {0}, {1} engine'.format(
+                                     poss_drop, engine))
+
+class TestPECache(unittest.TestCase):
+
+    def test_pe_cache(self):
+        df, true_TE = generate_uniform_given_importance(num_control=300, num_treated=300)
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
+        for model, pre_dame in [(matching.DAME(verbose=0, want_pe=True), None),
+                                (matching.FLAME(verbose=0, want_pe=True,
+                                                early_stop_pe=False), 1)]:
+            model.fit(holdout_data=holdout)
+            if pre_dame:
+                first = model.predict(df, pre_dame=pre_dame)
+            else:
+                first = model.predict(df)
+            first_pe = model.pe_each_iter
+            misses = model.pe_cache.misses
+            if pre_dame:
+                second = model.predict(df, pre_dame=pre_dame)
+            else:
+                second = model.predict(df)
+            self.assertTrue(first.equals(second),
+                            msg='Matches change when PEs are cached')
+            self.assertEqual(first_pe, model.pe_each_iter,
+                             msg='PEs change when they are cached')
+            self.assertEqual(misses, model.pe_cache.misses,
+                             msg='PEs of a second predict are not cached')
+
+        # least recently used PEs are evicted first
+        cache = flame_dame_helpers.PECache(maxsize=2)
+        cache.put('a', 1.0)
+        cache.put('b', 2.0)
+        cache.get('a')
+        cache.put('c', 3.0)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1.0, 3.0))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+class TestPEEngines(unittest.TestCase):
+
+    def test_ridge_gram_pe(self):
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=80)
+        covs = [col for col in holdout.columns if col not in ['treated', 'outcome']]
+        covar_sets = [frozenset(), frozenset(covs[:1]), frozenset(covs[1:3]),
+                      frozenset(covs)]
+        holdout_arrays = flame_dame_helpers.HoldoutArrays([holdout], 'treated',
+                                                          'outcome')
+        for alpha, adaptive_weights, cv in [(0.1, 'ridge', None),
+                                            (10.0, 'ridge', None),
+                                            (0.1, 'ridgeCV', 5)]:
+            engine = flame_dame_helpers.RidgeGramPE(holdout_arrays, alpha, cv)
+            pes = engine.pe(covar_sets)
+            for covar_set, pe in zip(covar_sets, pes):
+                fit_pe = flame_dame_helpers.find_pe_for_covar_set(
+                    [holdout], 'treated', 'outcome', covar_set,
+                    adaptive_weights, alpha)
+                if fit_pe is False:
+                    self.assertTrue(pe is False)
+                else:
+                    self.assertAlmostEqual(pe, fit_pe, places=8)
+
+    def test_ridge_gram_pe_near_perfect_fit(self):
+        # the sum of squared errors cancels out when expanded from the stats,
+        # so these sets are fit instead
+        rng = np.random.RandomState(0)
+        holdout = pd.DataFrame(rng.randint(0, 5, size=(400, 6)),
+                               columns=['x' + str(j) for j in range(6)])
+        holdout['treated'] = np.arange(400) % 2
+        holdout['outcome'] = 1e4 * holdout['x0'] + 3e3 * holdout['x1'] + \
+            1e-3 * rng.randn(400)
+        covar_sets = [frozenset(), frozenset(['x5']), frozenset(['x4', 'x5'])]
+        holdout_arrays = flame_dame_helpers.HoldoutArrays([holdout], 'treated',
+                                                          'outcome')
+        for adaptive_weights, cv in [('ridge', None), ('ridgeCV', 5)]:
+            engine = flame_dame_helpers.RidgeGramPE(holdout_arrays, 1e-6, cv)
+            for covar_set, pe in zip(covar_sets, engine.pe(covar_sets)):
+                fit_pe = flame_dame_helpers.find_pe_for_covar_set(
+                    [holdout], 'treated', 'outcome', covar_set,
+                    adaptive_weights, 1e-6)
+                self.assertAlmostEqual(pe / fit_pe, 1, places=6)
+
+    def test_ridge_cv_tiny_holdout(self):
+        # with fewer units in an arm than folds, the error of cross_val_score
+        df, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
+        holdout, true_TE = generate_uniform_given_importance(num_control=4, num_treated=8)
+        for model_class in [matching.FLAME, matching.DAME]:
+            model = model_class(verbose=0, adaptive_weights='ridgeCV')
+            model.fit(holdout_data=holdout)
+            with self.assertRaisesRegex(ValueError, 'n_splits=5'):
+                model.predict(df)
+
+    def test_group_mean_pe(self):
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=80)
+        covs = [col for col in holdout.columns if col not in ['treated', 'outcome']]
+        covar_sets = [frozenset(), frozenset(covs[:1]), frozenset(covs[1:3]),
+                      frozenset(covs)]
+        engine = flame_dame_helpers.GroupMeanPE(flame_dame_helpers.HoldoutArrays(
+            [holdout], 'treated', 'outcome'))
+        for covar_set, pe in zip(covar_sets, engine.pe(covar_sets)):
+            fit_pe = flame_dame_helpers.find_pe_for_covar_set(
+                [holdout], 'treated', 'outcome', covar_set, 'decisiontree', 0.1)
+            if fit_pe is False:
+                self.assertTrue(pe is False)
+            else:
+                self.assertAlmostEqual(pe, fit_pe, places=8)
+
+        # missing values are a value of their own
+        missing = holdout.astype({covs[0]: float})
+        missing.loc[missing.index % 3 == 0, covs[0]] = np.nan
+        replaced = missing.fillna({covs[0]: -1})
+        pes = [flame_dame_helpers.GroupMeanPE(flame_dame_helpers.HoldoutArrays(
+            [df], 'treated', 'outcome')).pe(covar_sets[1:3])
+               for df in [missing, replaced]]
+        self.assertEqual(pes[0], pes[1])
+
+    def test_one_hot_blocks(self):
+        holdout, true_TE = generate_uniform_given_importance(num_control=50, num_treated=40,
+                                                             min_val=0, max_val=12)
+        holdout.columns = holdout.columns.map(str)
+        holdout['binary'] = holdout.index % 2
+        holdout_arrays = flame_dame_helpers.HoldoutArrays([holdout], 'treated',
+                                                          'outcome', one_hot=True)
+        for covs_drop in [[], ['0'], ['1', '2']]:
+            for arm, treated in [(0, 1), (1, 0)]:
+                x = holdout.loc[holdout['treated'] == treated,
+                                holdout.columns.difference(['treated', 'outcome'] + covs_drop)]
+                dummies = pd.concat([pd.get_dummies(x.drop(columns=['binary']).astype(str)),
+                                     x[['binary']]], axis=1)
+                blocks = holdout_arrays.binarized(0, arm, holdout_arrays.columns(covs_drop))
+                self.assertEqual(dummies.shape, blocks.shape)
+                self.assertTrue((dummies.values.astype(int) == blocks).all())
+
+    def test_pe_engine(self):
+        df, true_TE = generate_uniform_given_importance(num_control=200, num_treated=200)
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
+
+        class CountingPE(flame_dame_helpers.GroupMeanPE):
+            num_sets = 0
+            def pe(self, covar_sets, n_jobs=1):
+                CountingPE.num_sets += len(covar_sets)
+                return super().pe(covar_sets, n_jobs)
+
+        outputs = []
+        for adaptive_weights in ['decisiontree', CountingPE]:
+            model = matching.FLAME(verbose=0, adaptive_weights=adaptive_weights,
+                                   want_pe=True)
+            model.fit(holdout_data=holdout)
+            outputs.append((model.predict(df), model.pe_each_iter))
+        self.assertTrue(CountingPE.num_sets > 0)
+        self.assertTrue(outputs[0][0].equals(outputs[1][0]))
+        self.assertEqual(outputs[0][1], outputs[1][1])
+
+        # estimators are cloned for each fit, not fit in place
+        estimator = DecisionTreeRegressor()
+        model = matching.DAME(verbose=0, adaptive_weights=estimator)
+        model.fit(holdout_data=holdout)
+        model.predict(df)
+        self.assertFalse(hasattr(estimator, 'tree_'))
+
+class TestSuccessiveHalving(unittest.TestCase):
+
+    def test_successive_halving(self):
+        # on a few draws FLAME never gets to rule out a set, so fix the data
+        np.random.seed(0)
+        df, true_TE = generate_uniform_given_importance(num_control=300, num_treated=300)
+        holdout, true_TE = generate_uniform_given_importance(num_control=2000, num_treated=2000)
+        for model_class in [matching.FLAME, matching.DAME]:
+            outputs = []
+            for successive_halving in [False, 100]:
+                model = model_class(verbose=0, want_pe=True,
+                                    successive_halving=successive_halving)
+                model.fit(holdout_data=holdout)
+                outputs.append((model.predict(df), model.pe_each_iter))
+            self.assertTrue(outputs[0][0].equals(outputs[1][0]))
+            self.assertEqual(outputs[0][1], outputs[1][1])
+            # DAME scores the sets ruled out later on if they come up, so it
+            # may not avoid any in a run that goes through the lattice
+            if model_class == matching.FLAME:
+                self.assertTrue(model.pe_cache.avoided > 0)
+
+        # the bounds use the t quantile of the chunks' degrees of freedom
+        screen = flame_dame_helpers.SuccessiveHalving(
+            flame_dame_helpers.HoldoutArrays([holdout], 'treated', 'outcome'),
+            'ridge', 0.1, 100)
+        self.assertAlmostEqual(screen.quantile, 3.182, places=3)
+
+    def test_successive_halving_avoided(self):
+        covar_importance = [4, 3, 2, 1, 1, 0.5, 0.5, 0.2]
+        df, true_TE = generate_uniform_given_importance(
+            num_control=300, num_treated=300, num_cov=8,
+            covar_importance=covar_importance)
+        holdout, true_TE = generate_uniform_given_importance(
+            num_control=2000, num_treated=2000, num_cov=8,
+            covar_importance=covar_importance)
+        num_treated = holdout['treated'].sum()
+
+        class CountingPE(flame_dame_helpers.RidgeGramPE):
+            num_full = 0
+            def pe(self, covar_sets, n_jobs=1):
+                # the PEs on the full holdout, not on the samples
+                if len(self.holdout.holdouts[0][1]) == num_treated:
+                    CountingPE.num_full += len(covar_sets)
+                return super().pe(covar_sets, n_jobs)
+
+        # avoided is the number of sets that were never scored on the full
+        # holdout, even when DAME scores a set it ruled out later on
+        for model_class in [matching.FLAME, matching.DAME]:
+            misses = []
+            for successive_halving in [False, 100]:
+                CountingPE.num_full = 0
+                model = model_class(verbose=0, adaptive_weights=CountingPE,
+                                    early_stop_pe=False, early_stop_iterations=4,
+                                    successive_halving=successive_halving)
+                model.fit(holdout_data=holdout)
+                model.predict(df)
+                cache = model.pe_cache
+                self.assertEqual(CountingPE.num_full, cache.misses - cache.avoided)
+                misses.append(cache.misses)
+            self.assertEqual(misses[0], misses[1])
+
+class TestDameLattice(unittest.TestCase):
+
+    def test_covariate_lattice(self):
+        lattice = generate_new_active_sets.CovariateLattice(['a', 'b', 'c', 'd'])
+        self.assertEqual(lattice.mask(['a', 'c']), 5)
+        self.assertEqual(lattice.covar_set(5), frozenset(['a', 'c']))
+
+        # the sets of size 2 become active once all their subsets are processed
+        lattice.add_processed(lattice.mask(['a']))
+        lattice.add_processed(lattice.mask(['b']))
+        new_sets = lattice.new_active_sets(lattice.mask(['c']))
+        self.assertEqual(new_sets, {lattice.mask(['a', 'c']),
+                                    lattice.mask(['b', 'c'])})
+        self.assertEqual(
+            generate_new_active_sets.algo3GenerateNewActiveSets(
+                frozenset(['c']), {frozenset(['a']), frozenset(['b'])}),
+            {frozenset(['a', 'c']), frozenset(['b', 'c'])})
+
+        # {a, b, c} needs all of its subsets of size 2
+        lattice.add_processed(lattice.mask(['c']))
+        lattice.add_processed(lattice.mask(['a', 'c']))
+        self.assertEqual(lattice.new_active_sets(lattice.mask(['a', 'b'])), set())
+        lattice.add_processed(lattice.mask(['a', 'b']))
+        self.assertEqual(lattice.new_active_sets(lattice.mask(['b', 'c'])),
+                         {lattice.mask(['a', 'b', 'c'])})
+
+    def test_covariate_lattice_support(self):
+        lattice = generate_new_active_sets.CovariateLattice(['a', 'b', 'c', 'd'])
+        for covar_set in [['a'], ['b'], ['c'], ['a', 'c']]:
+            lattice.add_processed(lattice.mask(covar_set))
+        self.assertEqual(lattice.support[1], [1, 1, 1, 0])
+        self.assertEqual(lattice.supported[1], lattice.mask(['a', 'b', 'c']))
+        self.assertEqual(lattice.support[2], [1, 0, 1, 0])
+        self.assertEqual(lattice.supported.get(2, 0), 0)
+
+        # the support is counted as the sets are added, and only once each
+        lattice.add_processed(lattice.mask(['a', 'b']))
+        lattice.add_processed(lattice.mask(['a', 'b']))
+        self.assertEqual(lattice.support[2], [2, 1, 1, 0])
+        self.assertEqual(lattice.supported[2], lattice.mask(['a']))
+
+class TestDameActiveSets(unittest.TestCase):
+
+    def test_dame_active_set_heap(self):
+        df, true_TE = generate_uniform_given_importance(num_control=200, num_treated=200)
+        holdout, true_TE = generate_uniform_given_importance(num_control=100, num_treated=100)
+
+        # each active set is scored once, when it becomes active
+        model = matching.DAME(verbose=0, want_pe=True)
+        model.fit(holdout_data=holdout)
+        model.predict(df)
+        self.assertEqual(model.pe_cache.hits, 0)
+
+        active_sets = dame_algorithm.ActiveSets()
+        active_sets.push(6, 0.5)
+        active_sets.push(5, 0.25, False)
+        active_sets.push(3, 0.25)
+        self.assertEqual(active_sets.masks(), [3, 5, 6])
+        self.assertEqual(active_sets.pop(), (0.25, 3, True))
+        self.assertEqual(active_sets.pop(), (0.25, 5, False))
+        self.assertEqual(len(active_sets), 1)
+
+    def test_fixed_weight_heap(self):
+        # with weights, the last of the sets tied for the most weight is kept
+        active_sets = dame_algorithm.ActiveSets(largest_first=True)
+        for mask in [1, 2, 4]:
+            active_sets.push(mask, -0.5)
+        self.assertEqual(active_sets.top(), (-0.5, 4, True))
+        self.assertEqual([active_sets.pop()[1] for _ in range(3)], [4, 2, 1])